@@ -0,0 +1,400 @@
+"""Benchmark the catalog, download and upload paths of the plugin repository.
+
+Seeds a synthetic database in a temporary directory, drives the Flask app
+through its test client and prints throughput, latency percentiles and
+query counts per scenario as JSON, e.g.
+
+    python benchmarks/run.py --plugins 10000 --output bench.json
+
+Results of two commits can be compared by diffing the JSON files.
+"""
+import argparse
+import base64
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--plugins", type=int, default=1000, help="plugins to seed")
+    parser.add_argument("--roles", type=int, default=50, help="roles to seed")
+    parser.add_argument("--tags", type=int, default=200, help="tags to seed")
+    parser.add_argument(
+        "--requests", type=int, default=200, help="requests per scenario"
+    )
+    parser.add_argument(
+        "--upload-sizes",
+        default="10000,1000000,10000000",
+        help="comma separated sizes in bytes of the uploaded plugins",
+    )
+    parser.add_argument("--uploads", type=int, default=10, help="uploads per size")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    parser.add_argument("--output", help="write the results to this file")
+    return parser.parse_args()
+
+
+def make_package(name, plugin_version, payload_size=0, tags="benchmark"):
+    """Return a plugin zip file with metadata.txt and an icon."""
+    stem = name.lower()
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_file:
+        zip_file.writestr(
+            f"{stem}/metadata.txt",
+            "\n".join(
+                [
+                    "[general]",
+                    f"name={name}",
+                    "qgisMinimumVersion=3.0",
+                    "qgisMaximumVersion=3.99",
+                    f"description=Benchmark plugin {name}",
+                    f"about={'About this benchmark plugin. ' * 20}",
+                    f"version={plugin_version}",
+                    "author=Benchmark",
+                    "email=benchmark@example.com",
+                    "repository=https://example.com/benchmark",
+                    f"tags={tags}",
+                    "icon=icon.png",
+                    f"changelog={'A change. ' * 20}",
+                ]
+            ),
+        )
+        zip_file.writestr(f"{stem}/icon.png", b"\x89PNG" + stem.encode())
+        if payload_size:
+            # random data doesn't compress, the zip has about the given size
+            zip_file.writestr(
+                f"{stem}/data.bin", os.urandom(payload_size), zipfile.ZIP_STORED
+            )
+    return buffer.getvalue()
+
+
+def basic_auth(username, password):
+    token = base64.b64encode(f"{username}:{password}".encode()).decode()
+    return {"Authorization": f"Basic {token}"}
+
+
+def seed(args, db, plugin_dir, icon_dir):
+    """Fill the database with plugins, roles, tags and users."""
+    from sqlalchemy.orm import selectinload
+
+    from repo.helpers import version_key
+    from repo.models import (
+        Plugin,
+        Role,
+        Tag,
+        User,
+        plugin_role_permissions_association,
+        plugin_tag_association,
+        user_role_association,
+    )
+    from repo.search import index_plugins
+
+    rng = random.Random(args.seed)
+
+    roles = [{"id": i + 1, "name": f"role{i}"} for i in range(args.roles)]
+    tags = [{"id": i + 1, "name": f"tag{i}"} for i in range(args.tags)]
+    db.session.bulk_insert_mappings(Role, roles)
+    db.session.bulk_insert_mappings(Tag, tags)
+
+    member = User(name="member", superuser=False)
+    member.set_password("benchmark")
+    db.session.add(member)
+    db.session.flush()
+    member_roles = rng.sample(range(1, args.roles + 1), min(5, args.roles))
+    db.session.execute(
+        user_role_association.insert(),
+        [{"user_id": member.id, "role_id": role_id} for role_id in member_roles],
+    )
+
+    admin = User.query.filter_by(superuser=True).first()
+    plugins, plugin_tags, plugin_roles = [], [], []
+    for i in range(1, args.plugins + 1):
+        name = f"Plugin{i}"
+        file_name = f"plugin{i}.zip"
+        package = make_package(name, "1.0")
+        (plugin_dir / file_name).write_bytes(package)
+        (icon_dir / f"plugin{i}.png").write_bytes(b"\x89PNG" + name.encode())
+        minimum = rng.choice(["3.0", "3.10", "3.16", "3.22", "3.28"])
+        plugins.append(
+            {
+                "id": i,
+                "md5_sum": f"{i:032x}",
+                "file_name": file_name,
+                "user_id": admin.id,
+                "public": rng.random() < 0.7,
+                "downloads": 0,
+                "name": name,
+                "qgisminimumversion": minimum,
+                "qgismaximumversion": "3.99",
+                "qgis_minimum_key": version_key(minimum),
+                "qgis_maximum_key": version_key("3.99"),
+                "description": f"Benchmark plugin {name}",
+                "about": "About this benchmark plugin. " * 20,
+                "version": "1.0",
+                "author": "Benchmark",
+                "email": "benchmark@example.com",
+                "repository": "https://example.com/benchmark",
+                "changelog": "A change. " * 20,
+                "icon": f"/icons/plugin{i}.png",
+            }
+        )
+        for tag_id in rng.sample(range(1, args.tags + 1), min(5, args.tags)):
+            plugin_tags.append({"plugin_id": i, "tag_id": tag_id})
+        for role_id in rng.sample(range(1, args.roles + 1), min(2, args.roles)):
+            plugin_roles.append({"plugin_id": i, "role_id": role_id})
+
+    db.session.bulk_insert_mappings(Plugin, plugins)
+    if plugin_tags:
+        db.session.execute(plugin_tag_association.insert(), plugin_tags)
+    if plugin_roles:
+        db.session.execute(plugin_role_permissions_association.insert(), plugin_roles)
+    index_plugins(Plugin.query.options(selectinload(Plugin.tags)))
+    db.session.commit()
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(db, request, count, before=None):
+    """Run a request count times and return its statistics."""
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    queries = [0]
+
+    def count_query(*args):
+        queries[0] += 1
+
+    # read-only requests use their own engine, count the queries of all engines
+    event.listen(Engine, "before_cursor_execute", count_query)
+    latencies, statuses, response_bytes = [], {}, 0
+    try:
+        started = time.perf_counter()
+        for i in range(count):
+            if before:
+                before(i)
+            request_started = time.perf_counter()
+            response = request(i)
+            latencies.append(time.perf_counter() - request_started)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            response_bytes += len(response.data)
+        total = time.perf_counter() - started
+    finally:
+        event.remove(Engine, "before_cursor_execute", count_query)
+
+    latencies.sort()
+    return {
+        "requests": count,
+        "seconds": round(total, 4),
+        "requests_per_second": round(count / total, 2),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.5) * 1000, 3),
+            "p90": round(percentile(latencies, 0.9) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3),
+        },
+        "queries_per_request": round(queries[0] / count, 2),
+        "bytes_per_request": response_bytes // count,
+        "status_codes": {str(code): n for code, n in sorted(statuses.items())},
+    }
+
+
+def run_scenarios(args, app, db):
+    from sqlalchemy import text
+
+    from repo.catalog import clear_cache
+    from repo.downloads import download_counter
+
+    client = app.test_client()
+    admin = basic_auth("admin", "admin")
+    member = basic_auth("member", "benchmark")
+    rng = random.Random(args.seed)
+    results = {}
+
+    def get(url, headers=None):
+        return lambda i: client.get(url, headers=headers or {})
+
+    def cold(i):
+        clear_cache()
+
+    for name, headers in [
+        ("anonymous", None),
+        ("role", member),
+        ("superuser", admin),
+    ]:
+        results[f"catalog_{name}_cold"] = measure(
+            db, get("/plugins.xml", headers), max(1, args.requests // 10), cold
+        )
+        results[f"catalog_{name}_warm"] = measure(
+            db, get("/plugins.xml", headers), args.requests
+        )
+
+    for name, url in [
+        ("json", "/plugins.json"),
+        ("json_fields", "/plugins.json?fields=name,version,download_url"),
+    ]:
+        results[f"catalog_{name}_cold"] = measure(
+            db, get(url), max(1, args.requests // 10), cold
+        )
+        results[f"catalog_{name}_warm"] = measure(db, get(url), args.requests)
+
+    etag = client.get("/plugins.xml").headers.get("ETag")
+    if etag:
+        results["catalog_not_modified"] = measure(
+            db, get("/plugins.xml", {"If-None-Match": etag}), args.requests
+        )
+
+    qgis_versions = ["3.4", "3.10", "3.16", "3.22", "3.28", "3.34"]
+    results["catalog_qgis_cold"] = measure(
+        db,
+        lambda i: client.get(f"/plugins.xml?qgis={qgis_versions[i % 6]}"),
+        max(1, args.requests // 10),
+        cold,
+    )
+    results["catalog_qgis_warm"] = measure(
+        db,
+        lambda i: client.get(f"/plugins.xml?qgis={qgis_versions[i % 6]}"),
+        args.requests,
+    )
+    results["listing_html"] = measure(db, get("/"), max(1, args.requests // 10))
+    for sort in ["date", "downloads"]:
+        results[f"listing_html_{sort}"] = measure(
+            db, get(f"/?sort={sort}"), max(1, args.requests // 10)
+        )
+    results["search_json"] = measure(
+        db,
+        lambda i: client.get(f"/search.json?q=plugin{rng.randint(1, args.plugins)}"),
+        args.requests,
+    )
+    results["search_json_role"] = measure(
+        db,
+        lambda i: client.get(f"/search.json?q=tag{i % args.tags}", headers=member),
+        args.requests,
+    )
+
+    with db.engine.connect() as connection:
+        public_ids = [
+            plugin_id
+            for (plugin_id,) in connection.execute(
+                "SELECT id FROM plugin WHERE public ORDER BY id"
+            )
+        ]
+    if public_ids:
+        results["download"] = measure(
+            db,
+            lambda i: client.get(f"/download/plugin{rng.choice(public_ids)}.zip"),
+            args.requests,
+        )
+        download_counter.flush()
+        results["icon"] = measure(
+            db,
+            lambda i: client.get(f"/icons/plugin{rng.choice(public_ids)}.png"),
+            args.requests,
+        )
+
+    for size in [int(s) for s in args.upload_sizes.split(",") if s]:
+        packages = [
+            make_package(f"Upload{size}x{i}", "1.0", size) for i in range(args.uploads)
+        ]
+        results[f"upload_{size}"] = measure(
+            db,
+            lambda i: client.post(
+                "/upload",
+                data={"file": (io.BytesIO(packages[i]), f"upload{i}.zip")},
+                headers=admin,
+                content_type="multipart/form-data",
+            ),
+            args.uploads,
+        )
+        # a failed upload redirects like a successful one, count what was stored
+        with db.engine.connect() as connection:
+            stored = connection.execute(
+                text("SELECT count(*) FROM plugin WHERE name LIKE :pattern"),
+                pattern=f"Upload{size}x%",
+            ).scalar()
+        results[f"upload_{size}"]["failed"] = args.uploads - stored
+        if stored < args.uploads:
+            print(
+                f"{args.uploads - stored} of {args.uploads} uploads of {size} bytes "
+                "failed",
+                file=sys.stderr,
+            )
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args = parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="gbd-plugin-bench-") as tmp:
+        tmp = Path(tmp)
+        plugin_dir, icon_dir = tmp / "dl", tmp / "icons"
+        plugin_dir.mkdir()
+        icon_dir.mkdir()
+        # the app reads its configuration on import
+        os.environ.update(
+            SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp / 'plugin.db'}",
+            GBD_PLUGIN_PATH=str(plugin_dir),
+            GBD_ICON_PATH=f"{icon_dir}/",
+            GBD_DOWNLOAD_FLUSH_SIZE=str(10**9),
+        )
+        sys.path.insert(0, str(ROOT))
+        # keep stdout clean for the report
+        with contextlib.redirect_stdout(sys.stderr):
+            from repo import app, db
+
+        app.logger.disabled = True
+        with app.app_context():
+            started = time.perf_counter()
+            seed(args, db, plugin_dir, icon_dir)
+            seed_seconds = time.perf_counter() - started
+        # every request has to get its own app context and session
+        results = run_scenarios(args, app, db)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "plugins": args.plugins,
+            "roles": args.roles,
+            "tags": args.tags,
+            "seed_seconds": round(seed_seconds, 2),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,17 +4,17 @@ import os
 
 from flask import Flask
 from flask_login import LoginManager
-from flask_sqlalchemy import SQLAlchemy
 
 from repo.rpc import HTTPAuthXMLRPCHandler
 
 if os.getenv("SENTRY_TELEMETRY", "0") == "1":
     import sentry_sdk
+
     sentry_sdk.init(
         dsn="https://3a467080a00c1ddccced9359f9a1b9c9@sentry.gbd-consult.de/2",
         # Set traces_sample_rate to 1.0 to capture 100%
         # of transactions for tracing.
-        traces_sample_rate=1.0,
+        traces_sample_rate=float(os.getenv("SENTRY_TRACES_SAMPLE_RATE", "1.0")),
     )
 
 app = Flask(__name__)
@@ -30,17 +30,22 @@ if __name__ != "__main__":
     app.logger.setLevel(gunicorn_logger.level)
 
 
-db = SQLAlchemy(app)
+from repo.database import RoutingSQLAlchemy
+
+db = RoutingSQLAlchemy(app)
 login_manager = LoginManager(app)
 login_manager.login_view = "login"
 
 rpc_handler = HTTPAuthXMLRPCHandler("rpc")
 rpc_handler.connect(app, "/rpc")
 
-from repo import auth, models, plugins
-# on a fresh DB run create_all
+from repo import auth, metrics, models, plugins, search
+from repo.catalog import preload_catalog
 from repo.helpers import create_superuser, db_is_populated
+from repo.migrations import stamp_schema_version, upgrade_db
+from repo.search import create_search_index
 
+# on a fresh DB run create_all
 if not db_is_populated():
     print("no database found, generating new one")
     if not os.path.isdir(app.config["GBD_PLUGIN_PATH"]):
@@ -51,3 +56,15 @@ if not db_is_populated():
     su = create_superuser()
     db.session.add(su)
     db.session.commit()
+    create_search_index()
+    stamp_schema_version()
+else:
+    upgrade_db()
+
+if app.config["GBD_PRELOAD_CATALOG_URL"]:
+    preload_catalog(app.config["GBD_PRELOAD_CATALOG_URL"])
+
+# don't hand the startup work or database connections down to forked workers
+db.session.remove()
+db.engine.dispose()
+metrics.reset()
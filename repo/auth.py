@@ -1,11 +1,66 @@
 """Authentication end points."""
+import hashlib
+import hmac
+import threading
+import time
+
 from flask import abort, flash, redirect, render_template, request, url_for
 from flask_login import current_user, login_required, login_user, logout_user
 from werkzeug.urls import url_parse
 
 from repo import app, db, login_manager
+from repo.catalog import add_tombstone, invalidate_catalog
 from repo.models import Plugin, Role, User
 
+# Basic auth credentials that were verified recently. Checking a password
+# hash is slow on purpose, and clients send their credentials with every
+# request. Maps an HMAC of username and password to the user id, the
+# password hash that was checked and the time the entry expires.
+_verified_credentials = {}
+_verified_credentials_lock = threading.Lock()
+
+
+def _credentials_key(username, password):
+    """Return the cache key for a username and password."""
+    message = f"{username}\0{password}".encode()
+    secret = app.config["SECRET_KEY"].encode()
+    return hmac.new(secret, message, hashlib.sha256).digest()
+
+
+def _cached_user(key, username):
+    """Return the user for verified credentials, None if there are none."""
+    entry = _verified_credentials.get(key)
+    if entry is None:
+        return None
+    user_id, password_hash, expires = entry
+    if expires < time.monotonic():
+        return None
+
+    user = User.query.get(user_id)
+    # the password may have been changed by another worker
+    if user and user.name == username and user.password_hash == password_hash:
+        return user
+    return None
+
+
+def _remember_credentials(key, user):
+    """Remember verified credentials."""
+    expires = time.monotonic() + app.config["GBD_AUTH_CACHE_TTL"]
+    with _verified_credentials_lock:
+        # drop the oldest entries, dicts keep insertion order
+        while len(_verified_credentials) >= app.config["GBD_AUTH_CACHE_SIZE"]:
+            del _verified_credentials[next(iter(_verified_credentials))]
+        _verified_credentials.pop(key, None)
+        _verified_credentials[key] = (user.id, user.password_hash, expires)
+
+
+def forget_credentials(user_id):
+    """Forget the verified credentials of a user."""
+    with _verified_credentials_lock:
+        for key, entry in list(_verified_credentials.items()):
+            if entry[0] == user_id:
+                del _verified_credentials[key]
+
 
 @login_manager.request_loader
 def load_user_from_header(request):
@@ -14,12 +69,18 @@ def load_user_from_header(request):
         # no basic auth provided, continue with normal auth
         return None
 
+    key = _credentials_key(auth.username, auth.password)
+    user = _cached_user(key, auth.username)
+    if user:
+        return user
+
     user = User.query.filter_by(name=auth.username).first()
     if not user or not user.check_password(auth.password):
         # wrong basic auth provided deny access
         abort(401)
 
     # basic auth works
+    _remember_credentials(key, user)
     return user
 
 
@@ -112,6 +173,26 @@ def add_user():
         return render_template("user.html", roles=roles)
 
 
+def tombstone_lost_plugins(user, role_ids=None):
+    """Let the mirrors of a user remove the plugins it can't see anymore.
+
+    Arguments:
+    ---------
+        user : User
+            the user, with the roles it has now.
+        role_ids : set
+            the roles the user lost, None if it lost the superuser flag.
+    """
+    remaining_role_ids = [role.id for role in user.roles]
+    plugins = Plugin.query.filter(
+        Plugin.public.is_(False), ~Plugin.roles.any(Role.id.in_(remaining_role_ids))
+    )
+    if role_ids is not None:
+        plugins = plugins.filter(Plugin.roles.any(Role.id.in_(role_ids)))
+    for plugin in plugins:
+        add_tombstone(plugin, False, (), user_ids={user.id})
+
+
 @app.route("/user/<int:user_id>/edit", methods=["GET", "POST"])
 @login_required
 def edit_user(user_id):
@@ -126,6 +207,8 @@ def edit_user(user_id):
 
         if request.method == "POST":
             changed = False
+            was_superuser = user.superuser
+            removed_role_ids = set()
             password = request.form.get("password")
             if not (password is None or password == ""):
                 if len(password) < 8:
@@ -164,6 +247,7 @@ def edit_user(user_id):
                     )
                 elif has_role and not should_have_role:
                     user.roles.remove(role)
+                    removed_role_ids.add(role.id)
                     changed = True
                     app.logger.info(
                         f"USER_ROLE_REMOVED: {role.name} added to user {user.name}({user.id}) by {current_user.name}"
@@ -171,7 +255,12 @@ def edit_user(user_id):
 
             if changed:
                 db.session.add(user)
+                if was_superuser and not user.superuser:
+                    tombstone_lost_plugins(user)
+                elif removed_role_ids and not user.superuser:
+                    tombstone_lost_plugins(user, removed_role_ids)
                 db.session.commit()
+                forget_credentials(user.id)
                 flash(f"successfuly changed user: {user.name}")
                 return redirect(url_for("get_users"))
             else:
@@ -201,6 +290,9 @@ def delete_user(user_id):
         db.session.commit()
         db.session.delete(user)
         db.session.commit()
+        forget_credentials(user.id)
+        # the catalog lists the uploader of each plugin
+        invalidate_catalog()
         flash(f"removed user {user.name}")
         app.logger.info(
             f"USER_REMOVED: {user.name}({user.id}) by user {current_user.name}"
@@ -290,8 +382,14 @@ def delete_role(role_id):
             return abort(404)
         # maybe add check to not delete admin role, if superuser ends up not being hardcoded
 
+        # the users lose the role, let their mirrors remove its plugins
+        user_ids = {user.id for user in role.users}
+        for plugin in role.plugins:
+            if user_ids and not plugin.public:
+                add_tombstone(plugin, False, (), user_ids=user_ids)
         db.session.delete(role)
         db.session.commit()
+        invalidate_catalog()
         flash(f"deleted role {role.name}")
         app.logger.info(f"ROLE_REMOVED: {role.name}({role.id}) by {current_user.name}")
         return redirect(url_for("get_roles"))
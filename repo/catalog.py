@@ -0,0 +1,573 @@
+"""Cache for the rendered plugins.xml and plugins.json catalogs.
+
+Building the catalog means loading every visible plugin and serializing it
+with lxml, so the serialized bytes are kept per visibility class. Writes that
+change the catalog call `invalidate_catalog`, which bumps a generation counter
+in the database so every worker process drops its cached copies.
+"""
+import gzip
+import hashlib
+import io
+import json
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from flask import request
+from lxml import etree
+from sqlalchemy import and_, exists, func, or_, select
+
+from repo import app, db, login_manager, metrics
+from repo.database import group_names
+from repo.models import (
+    XML_COLUMNS,
+    XML_FIELDS,
+    CatalogState,
+    Plugin,
+    PluginTombstone,
+    Tag,
+    User,
+    download_url_prefix,
+    plugin_download_url,
+    plugin_role_permissions_association,
+    plugin_tag_association,
+    serialize_plugins,
+    user_role_association,
+)
+
+_lock = threading.Lock()
+_cache = {}
+_generation = None
+
+CatalogVersion = namedtuple("CatalogVersion", ["generation", "last_modified"])
+# the serialized catalog, its compressed variants by encoding and when it was built
+CatalogEntry = namedtuple("CatalogEntry", ["body", "encoded", "built_at"])
+
+# content encodings the catalog can be sent with, in order of preference
+ENCODERS = {}
+try:
+    import brotli
+
+    ENCODERS["br"] = lambda data: brotli.compress(data, quality=9)
+except ImportError:
+    pass
+try:
+    import zstandard
+
+    ENCODERS["zstd"] = lambda data: zstandard.ZstdCompressor(level=10).compress(data)
+except ImportError:
+    pass
+ENCODERS["gzip"] = lambda data: gzip.compress(data, compresslevel=9, mtime=0)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# the tags of a plugin as comma separated names
+TAG_NAMES = func.coalesce(
+    select([group_names(Tag.name)])
+    .select_from(Tag.__table__.join(plugin_tag_association))
+    .where(plugin_tag_association.c.plugin_id == Plugin.id)
+    .correlate(Plugin.__table__)
+    .as_scalar(),
+    "",
+)
+
+# fields of plugins.json, named like the elements of plugins.xml
+JSON_FIELDS = {
+    element_name: getattr(Plugin, attribute)
+    for attribute, element_name, _ in XML_FIELDS
+    if attribute != "uploader_name"
+}
+JSON_FIELDS.update(
+    {
+        "uploaded_by": User.name,
+        # turned into the URL by build_json_catalog
+        "download_url": Plugin.file_name,
+        "tags": TAG_NAMES,
+    }
+)
+
+
+def visibility_key(user):
+    """Return the visibility class of a user.
+
+    Users that see the same set of plugins share a key: anonymous users and
+    users without roles only see public plugins, superusers see everything
+    and everyone else sees the public plugins plus those of their roles.
+    """
+    if user.is_anonymous:
+        return "public"
+    if user.superuser:
+        return "superuser"
+    role_ids = sorted(user.role_ids)
+    if not role_ids:
+        return "public"
+    return "roles:" + ",".join(str(role_id) for role_id in role_ids)
+
+
+def visible_plugins(user):
+    """Return a query for all plugins the user is allowed to see.
+
+    Relations of the plugins aren't loaded, add loader options for the ones
+    you need.
+    """
+    if user.is_anonymous:
+        return Plugin.query.filter_by(public=True)
+    elif user.superuser:
+        return Plugin.query
+    else:
+        plugin_role = plugin_role_permissions_association.c
+        user_role = user_role_association.c
+        shares_role = exists().where(
+            and_(
+                plugin_role.plugin_id == Plugin.id,
+                plugin_role.role_id == user_role.role_id,
+                user_role.user_id == user.id,
+            )
+        )
+        return Plugin.query.filter(or_(Plugin.public, shares_role))
+
+
+def filter_qgis_version(query, qgis_key):
+    """Only keep plugins compatible with a QGIS version.
+
+    Arguments:
+    ---------
+        query : Query
+            a query for plugins.
+        qgis_key : int
+            the QGIS version as returned by helpers.version_key.
+    """
+    return query.filter(
+        Plugin.qgis_minimum_key <= qgis_key, Plugin.qgis_maximum_key >= qgis_key
+    )
+
+
+# sort orders of the plugin listing: column and whether it is descending
+LISTING_SORTS = {
+    "name": (Plugin.name, False),
+    "date": (Plugin.update_date, True),
+    "downloads": (Plugin.downloads, True),
+}
+
+
+def plugin_listing(user, sort="name", after=None, qgis_key=None, limit=50):
+    """Return a query for one page of the plugin listing.
+
+    Selects only the columns plugins.html shows and pages with a keyset
+    instead of an offset, so a page costs the same wherever it is.
+
+    Arguments:
+    ---------
+        user : User
+            the requesting user.
+        sort : str
+            one of LISTING_SORTS.
+        after : tuple
+            the sort value and id of the last plugin of the previous page.
+        qgis_key : int
+            only list plugins for this QGIS version, see helpers.version_key.
+        limit : int
+            the number of plugins on a page.
+    """
+    column, descending = LISTING_SORTS[sort]
+    plugins = (
+        visible_plugins(user)
+        .outerjoin(Plugin.user)
+        .with_entities(
+            Plugin.id,
+            Plugin.name,
+            Plugin.version,
+            Plugin.update_date,
+            Plugin.downloads,
+            User.name.label("uploader_name"),
+        )
+    )
+    if qgis_key is not None:
+        plugins = filter_qgis_version(plugins, qgis_key)
+    if after is not None:
+        value, plugin_id = after
+        if descending:
+            plugins = plugins.filter(
+                or_(column < value, and_(column == value, Plugin.id < plugin_id))
+            )
+        else:
+            plugins = plugins.filter(
+                or_(column > value, and_(column == value, Plugin.id > plugin_id))
+            )
+    if descending:
+        plugins = plugins.order_by(column.desc(), Plugin.id.desc())
+    else:
+        plugins = plugins.order_by(column, Plugin.id)
+    return plugins.limit(limit)
+
+
+def catalog_query(user, qgis_key=None):
+    """Return a query for the rows of the catalog of the user.
+
+    The rows hold just what serialize_plugins needs, uploader name and tags
+    included, so a catalog takes a single query and no ORM objects.
+    """
+    plugins = (
+        visible_plugins(user)
+        .outerjoin(Plugin.user)
+        .with_entities(
+            *XML_COLUMNS,
+            User.name.label("uploader_name"),
+            TAG_NAMES.label("tag_names"),
+        )
+    )
+    if qgis_key is not None:
+        plugins = filter_qgis_version(plugins, qgis_key)
+    return plugins
+
+
+def json_catalog_query(user, fields, qgis_key=None):
+    """Return a query selecting only the given JSON_FIELDS of the catalog."""
+    plugins = visible_plugins(user)
+    if "uploaded_by" in fields:
+        plugins = plugins.outerjoin(Plugin.user)
+    plugins = plugins.with_entities(
+        *[JSON_FIELDS[field].label(field) for field in fields]
+    )
+    if qgis_key is not None:
+        plugins = filter_qgis_version(plugins, qgis_key)
+    return plugins
+
+
+def build_json_catalog(user, fields, qgis_key=None):
+    """Serialize the given fields of the plugins visible to the user to JSON."""
+    prefix = download_url_prefix()
+    converters = {
+        "download_url": lambda file_name: plugin_download_url(prefix, file_name),
+        "tags": lambda tag_names: tag_names.split(",") if tag_names else [],
+    }
+    converted = [
+        (i, converters[field]) for i, field in enumerate(fields) if field in converters
+    ]
+    plugins = []
+    for row in json_catalog_query(user, fields, qgis_key):
+        row = list(row)
+        for i, converter in converted:
+            row[i] = converter(row[i])
+        plugins.append(dict(zip(fields, row)))
+    return dumps_json({"plugins": plugins})
+
+
+def dumps_json(data):
+    """Serialize to JSON bytes, with orjson if it is installed."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(
+        data, separators=(",", ":"), ensure_ascii=False, default=datetime.isoformat
+    ).encode()
+
+
+def build_catalog(user, qgis_key=None):
+    """Serialize the plugins visible to the user into plugins.xml."""
+    plugin_root = etree.Element("plugins")
+    plugin_root.extend(serialize_plugins(catalog_query(user, qgis_key)))
+    return etree.tostring(plugin_root)
+
+
+def stream_catalog(user, qgis_key=None):
+    """Serialize the catalog of the user piece by piece.
+
+    Plugins are fetched in batches of GBD_CATALOG_STREAM_BATCH and written
+    as soon as they are serialized, so memory use doesn't grow with the size
+    of the catalog and the first bytes go out right away.
+    """
+    batch_size = app.config["GBD_CATALOG_STREAM_BATCH"]
+    plugins = catalog_query(user, qgis_key).order_by(Plugin.id).yield_per(batch_size)
+
+    buffer = io.BytesIO()
+    with etree.xmlfile(buffer) as xml_file:
+        with xml_file.element("plugins"):
+            for i, plugin_element in enumerate(serialize_plugins(plugins), 1):
+                xml_file.write(plugin_element)
+                if i % batch_size == 0:
+                    xml_file.flush()
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+    yield buffer.getvalue()
+
+
+def catalog_changes(user, since=None):
+    """Return what changed in the catalog of the user since a point in time.
+
+    Arguments:
+    ---------
+        user : User
+            the requesting user.
+        since : datetime
+            the cursor returned by the previous call, None for everything.
+
+    Returns the updated plugins, the tombstones of plugins that disappeared
+    and the cursor for the next call.
+    """
+    plugins = catalog_query(user)
+    if since is None:
+        # a full sync has nothing to delete, but its cursor has to be past the
+        # existing tombstones
+        tombstones = []
+        deleted_at = [db.session.query(func.max(PluginTombstone.deleted_at)).scalar()]
+    else:
+        plugins = plugins.filter(Plugin.update_date > since)
+        tombstones = (
+            PluginTombstone.query.filter(PluginTombstone.deleted_at > since)
+            .order_by(PluginTombstone.deleted_at)
+            .all()
+        )
+        deleted_at = [t.deleted_at for t in tombstones]
+    plugins = plugins.order_by(Plugin.update_date).all()
+
+    cursor = max(
+        filter(None, [since] + [p.update_date for p in plugins] + deleted_at),
+        default=None,
+    )
+    if tombstones:
+        # users that can still see a plugin, e.g. through another role, keep it
+        visible_ids = {
+            plugin_id
+            for (plugin_id,) in visible_plugins(user)
+            .filter(Plugin.id.in_({t.plugin_id for t in tombstones}))
+            .with_entities(Plugin.id)
+        }
+        tombstones = [
+            t
+            for t in tombstones
+            if t.has_access(user) and t.plugin_id not in visible_ids
+        ]
+    return plugins, tombstones, cursor
+
+
+def add_tombstone(plugin, public, role_ids, deleted_at=None, user_ids=()):
+    """Record that a plugin disappeared for some users.
+
+    Arguments:
+    ---------
+        plugin : Plugin
+            the deleted or restricted plugin.
+        public : bool
+            if the plugin was public before.
+        role_ids : set
+            the roles that had access to the plugin before.
+        deleted_at : datetime
+            the update_date the change gave the plugin, so a mirror that saw
+            the change doesn't get the tombstone again. Now if None.
+        user_ids : set
+            users that had access before through roles or the superuser flag
+            they don't have anymore.
+    """
+    db.session.add(
+        PluginTombstone(
+            plugin_id=plugin.id,
+            name=plugin.name,
+            file_name=plugin.file_name,
+            public=public,
+            role_ids=",".join(str(role_id) for role_id in sorted(role_ids)),
+            user_ids=",".join(str(user_id) for user_id in sorted(user_ids)),
+            deleted_at=deleted_at or datetime.utcnow(),
+        )
+    )
+
+
+def current_version():
+    """Return the current catalog version and drop stale cache entries.
+
+    This is a single aggregate query, so it is cheap enough to run on every
+    catalog request.
+    """
+    global _generation
+    newest_update, generation, changed_at = db.session.query(
+        func.max(Plugin.update_date),
+        db.session.query(CatalogState.generation).as_scalar(),
+        db.session.query(CatalogState.changed_at).as_scalar(),
+    ).one()
+    generation = generation or 0
+
+    if generation != _generation:
+        # another process changed the catalog
+        with _lock:
+            _cache.clear()
+            _generation = generation
+
+    last_modified = max(filter(None, [newest_update, changed_at]), default=None)
+    return CatalogVersion(generation, last_modified)
+
+
+def catalog_etag(catalog_version, user, qgis_key=None, encoding=None, fields=None):
+    """Return the ETag of the catalog the user gets for the given version.
+
+    The ETag is weak, it only changes with the plugins and not with their
+    download counts. A client that revalidates keeps the counts of its copy
+    until a plugin changes.
+    """
+    key = ":".join(
+        [
+            # the download URLs depend on the URL the catalog was requested at
+            request.url_root,
+            str(catalog_version.generation),
+            str(catalog_version.last_modified),
+            visibility_key(user),
+            str(qgis_key),
+            "xml" if fields is None else "json=" + ",".join(fields),
+        ]
+    )
+    etag = hashlib.sha1(key.encode()).hexdigest()
+    if encoding:
+        etag = f"{etag}-{encoding}"
+    return etag
+
+
+def get_catalog(user, qgis_key=None, catalog_version=None, encoding=None, fields=None):
+    """Return the serialized catalog for the user, from cache if possible.
+
+    Catalogs are cached per visibility class, QGIS version and the URL the
+    repository is reached at, clients cluster on a handful of QGIS releases.
+    A compressed variant is computed on the first request for it and cached
+    along with the catalog. Other requests are built without caching, see
+    cacheable.
+
+    Arguments:
+    ---------
+        user : User
+            the requesting user.
+        qgis_key : int
+            only list plugins for this QGIS version, see helpers.version_key.
+        catalog_version : CatalogVersion
+            the result of current_version, if it was already called.
+        encoding : str
+            one of ENCODERS, None for the uncompressed catalog.
+        fields : tuple
+            the JSON_FIELDS of a JSON catalog, None for plugins.xml.
+    """
+    if catalog_version is None:
+        current_version()
+    if not cacheable(qgis_key, fields):
+        metrics.inc("catalog_cache_requests_total", result="bypass")
+        if fields is None:
+            body = build_catalog(user, qgis_key)
+        else:
+            body = build_json_catalog(user, fields, qgis_key)
+        return ENCODERS[encoding](body) if encoding else body
+
+    key = (request.url_root, visibility_key(user), qgis_key, fields)
+    now = time.monotonic()
+
+    entry = _cache.get(key)
+    ttl = app.config["GBD_CATALOG_CACHE_TTL"]
+    if entry is not None and now - entry.built_at < ttl:
+        metrics.inc("catalog_cache_requests_total", result="hit")
+    else:
+        metrics.inc("catalog_cache_requests_total", result="miss")
+        if fields is None:
+            body = build_catalog(user, qgis_key)
+        else:
+            body = build_json_catalog(user, fields, qgis_key)
+        entry = CatalogEntry(body, {}, now)
+        with _lock:
+            _cache.pop(key, None)
+            _cache[key] = entry
+            shrink_cache()
+
+    if not encoding:
+        return entry.body
+    if encoding not in entry.encoded:
+        encoded = ENCODERS[encoding](entry.body)
+        with _lock:
+            entry.encoded.setdefault(encoding, encoded)
+            shrink_cache()
+    return entry.encoded[encoding]
+
+
+def cacheable(qgis_key, fields):
+    """Return whether a catalog is cached.
+
+    Only whole QGIS releases, as the plugin manager sends them, and all JSON
+    fields are cached, so arbitrary query strings can't fill the cache.
+    """
+    return (qgis_key is None or qgis_key % 10000 == 0) and fields in (
+        None,
+        tuple(JSON_FIELDS),
+    )
+
+
+def shrink_cache():
+    """Drop the oldest catalogs until the cache fits its limits.
+
+    The limits are GBD_CATALOG_CACHE_SIZE entries and GBD_CATALOG_CACHE_BYTES
+    of serialized and compressed catalogs. Must be called with _lock held.
+    """
+    sizes = {
+        key: len(entry.body) + sum(map(len, entry.encoded.values()))
+        for key, entry in _cache.items()
+    }
+    total = sum(sizes.values())
+    # dicts keep insertion order, the oldest entries come first
+    for key, size in sizes.items():
+        if (
+            total <= app.config["GBD_CATALOG_CACHE_BYTES"]
+            and len(_cache) <= app.config["GBD_CATALOG_CACHE_SIZE"]
+        ):
+            break
+        del _cache[key]
+        total -= size
+
+
+def preload_catalog(base_url):
+    """Build the catalog of anonymous users before the first request.
+
+    With gunicorn --preload this runs once in the master process and the
+    forked workers inherit the cache.
+
+    Arguments:
+    ---------
+        base_url : str
+            the public URL of the repository, used for the download links.
+    """
+    with app.test_request_context(base_url=base_url):
+        user = login_manager.anonymous_user()
+        catalog_version = current_version()
+        for encoding in [None, *ENCODERS]:
+            get_catalog(user, None, catalog_version, encoding)
+
+
+def invalidate_catalog():
+    """Mark all cached catalogs as stale, in this and every other worker.
+
+    Commits the current session.
+    """
+    mark_catalog_changed()
+    db.session.commit()
+    clear_cache()
+
+
+def mark_catalog_changed():
+    """Bump the catalog generation in the current session, without committing.
+
+    Lets a change and the bump commit together, the caller calls clear_cache
+    after the commit.
+    """
+    bumped = CatalogState.query.update(
+        {
+            CatalogState.generation: CatalogState.generation + 1,
+            CatalogState.changed_at: datetime.utcnow(),
+        },
+        synchronize_session=False,
+    )
+    if not bumped:
+        db.session.add(CatalogState(generation=1))
+
+
+def clear_cache():
+    """Drop the catalogs cached by this process."""
+    global _generation
+    with _lock:
+        _cache.clear()
+        _generation = None
@@ -24,3 +24,70 @@ APP_HOWTO = os.getenv("APP_HOWTO", False)
 # DEMO
 DEMO_USER = os.getenv("DEMO_USER", False)
 DEMO_PASSWORD = os.getenv("DEMO_PASSWORD", False)
+
+# Plugin catalog cache
+# seconds a rendered plugins.xml is reused, download counts are refreshed after that
+GBD_CATALOG_CACHE_TTL = int(os.getenv("GBD_CATALOG_CACHE_TTL", 300))
+# maximum number of rendered catalogs kept per worker
+GBD_CATALOG_CACHE_SIZE = int(os.getenv("GBD_CATALOG_CACHE_SIZE", 256))
+# maximum bytes of rendered and compressed catalogs kept per worker
+GBD_CATALOG_CACHE_BYTES = int(os.getenv("GBD_CATALOG_CACHE_BYTES", 64 * 1024 * 1024))
+# seconds clients and proxies may use plugins.xml before revalidating it
+GBD_CATALOG_MAX_AGE = int(os.getenv("GBD_CATALOG_MAX_AGE", 0))
+
+# also store the sha256 checksum of uploaded plugins
+GBD_PLUGIN_SHA256 = os.getenv("GBD_PLUGIN_SHA256", "1") == "1"
+
+# Let nginx send plugin files and icons using X-Accel-Redirect, the app only
+# checks access. The locations have to be internal locations in nginx.conf.
+GBD_X_ACCEL_REDIRECT = os.getenv("GBD_X_ACCEL_REDIRECT", "0") == "1"
+GBD_ACCEL_PLUGIN_LOCATION = os.getenv("GBD_ACCEL_PLUGIN_LOCATION", "/_accel/dl/")
+GBD_ACCEL_ICON_LOCATION = os.getenv("GBD_ACCEL_ICON_LOCATION", "/_accel/icons/")
+
+# Downloads are counted in memory and written every GBD_DOWNLOAD_FLUSH_INTERVAL
+# seconds or once GBD_DOWNLOAD_FLUSH_SIZE downloads were counted
+GBD_DOWNLOAD_FLUSH_INTERVAL = int(os.getenv("GBD_DOWNLOAD_FLUSH_INTERVAL", 10))
+GBD_DOWNLOAD_FLUSH_SIZE = int(os.getenv("GBD_DOWNLOAD_FLUSH_SIZE", 100))
+
+# Verified HTTP basic auth credentials are cached for GBD_AUTH_CACHE_TTL seconds
+GBD_AUTH_CACHE_TTL = int(os.getenv("GBD_AUTH_CACHE_TTL", 300))
+GBD_AUTH_CACHE_SIZE = int(os.getenv("GBD_AUTH_CACHE_SIZE", 1024))
+
+# directory the worker processes share their metrics in, empty to disable sharing
+GBD_METRICS_DIR = os.getenv("GBD_METRICS_DIR", "/tmp/gbd-plugin-repo-metrics")
+
+# Stream plugins.xml instead of caching it, for catalogs too big to keep in
+# memory. Plugins are loaded and written in batches of GBD_CATALOG_STREAM_BATCH.
+GBD_CATALOG_STREAMING = os.getenv("GBD_CATALOG_STREAMING", "0") == "1"
+GBD_CATALOG_STREAM_BATCH = int(os.getenv("GBD_CATALOG_STREAM_BATCH", 500))
+
+# Process uploads in a pool of GBD_UPLOAD_WORKERS threads per worker process.
+# Uploads then return a job id that can be polled at /upload/jobs/<id> or with
+# the plugin.upload_status XML-RPC method.
+GBD_ASYNC_UPLOADS = os.getenv("GBD_ASYNC_UPLOADS", "0") == "1"
+GBD_UPLOAD_WORKERS = int(os.getenv("GBD_UPLOAD_WORKERS", 2))
+
+# seconds clients may cache icons, they are stored under the hash of their content
+GBD_ICON_MAX_AGE = int(os.getenv("GBD_ICON_MAX_AGE", 31536000))
+
+# Build the catalog of anonymous users at startup, with gunicorn --preload the
+# workers inherit it. The public URL of the repository, used for the download
+# links, e.g. https://plugins.example.com/. Empty to disable.
+GBD_PRELOAD_CATALOG_URL = os.getenv("GBD_PRELOAD_CATALOG_URL", "")
+
+# SQLite tuning, applied to every connection. WAL lets readers and the writer
+# work at the same time, writers wait up to GBD_SQLITE_BUSY_TIMEOUT ms for a lock.
+GBD_SQLITE_JOURNAL_MODE = os.getenv("GBD_SQLITE_JOURNAL_MODE", "WAL")
+GBD_SQLITE_SYNCHRONOUS = os.getenv("GBD_SQLITE_SYNCHRONOUS", "NORMAL")
+GBD_SQLITE_BUSY_TIMEOUT = int(os.getenv("GBD_SQLITE_BUSY_TIMEOUT", 5000))
+GBD_SQLITE_MMAP_SIZE = int(os.getenv("GBD_SQLITE_MMAP_SIZE", 268435456))
+# negative values are KiB
+GBD_SQLITE_CACHE_SIZE = int(os.getenv("GBD_SQLITE_CACHE_SIZE", -65536))
+# read-only requests use a pool of this many read-only connections, 0 to disable
+GBD_SQLITE_READER_POOL_SIZE = int(os.getenv("GBD_SQLITE_READER_POOL_SIZE", 5))
+
+# maximum number of plugins /search returns
+GBD_SEARCH_LIMIT = int(os.getenv("GBD_SEARCH_LIMIT", 50))
+
+# plugins per page of the HTML listing
+GBD_PAGE_SIZE = int(os.getenv("GBD_PAGE_SIZE", 50))
@@ -4,3 +4,29 @@ SECRET_KEY = "notasecret"
 
 # DB Config
 SQLALCHEMY_DATABASE_URI = "sqlite:///development.db"
+
+GBD_CATALOG_CACHE_TTL = 300
+GBD_CATALOG_CACHE_SIZE = 256
+GBD_CATALOG_CACHE_BYTES = 64 * 1024 * 1024
+GBD_CATALOG_MAX_AGE = 0
+GBD_PLUGIN_SHA256 = True
+GBD_X_ACCEL_REDIRECT = False
+GBD_DOWNLOAD_FLUSH_INTERVAL = 10
+GBD_DOWNLOAD_FLUSH_SIZE = 1
+GBD_AUTH_CACHE_TTL = 300
+GBD_AUTH_CACHE_SIZE = 1024
+GBD_METRICS_DIR = ""
+GBD_CATALOG_STREAMING = False
+GBD_CATALOG_STREAM_BATCH = 500
+GBD_ASYNC_UPLOADS = False
+GBD_UPLOAD_WORKERS = 2
+GBD_ICON_MAX_AGE = 31536000
+GBD_PRELOAD_CATALOG_URL = ""
+GBD_SQLITE_JOURNAL_MODE = "WAL"
+GBD_SQLITE_SYNCHRONOUS = "NORMAL"
+GBD_SQLITE_BUSY_TIMEOUT = 5000
+GBD_SQLITE_MMAP_SIZE = 268435456
+GBD_SQLITE_CACHE_SIZE = -65536
+GBD_SQLITE_READER_POOL_SIZE = 5
+GBD_SEARCH_LIMIT = 50
+GBD_PAGE_SIZE = 50
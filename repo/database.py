@@ -0,0 +1,151 @@
+"""SQLite connection tuning and a read-only engine for read-only requests.
+
+Every SQLite connection gets the GBD_SQLITE_* pragmas. With WAL readers
+don't block the writer and the other way round, so views decorated with
+`read_only` run their queries on a separate pool of read-only connections
+and catalog polls never queue behind uploads or download counts.
+
+SQL that differs between databases is written with the helpers at the end,
+which pick the syntax of the dialect in use.
+"""
+import os
+import sqlite3
+from functools import wraps
+
+from flask import g, has_app_context
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import String, create_engine, event, orm
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.functions import FunctionElement
+
+from repo import app
+
+_reader_engine = None
+# the pool doesn't survive a fork, remember who created it
+_reader_pid = None
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {app.config['GBD_SQLITE_BUSY_TIMEOUT']}")
+    if app.config["GBD_SQLITE_JOURNAL_MODE"]:
+        cursor.execute(f"PRAGMA journal_mode = {app.config['GBD_SQLITE_JOURNAL_MODE']}")
+    if app.config["GBD_SQLITE_SYNCHRONOUS"]:
+        cursor.execute(f"PRAGMA synchronous = {app.config['GBD_SQLITE_SYNCHRONOUS']}")
+    cursor.execute(f"PRAGMA mmap_size = {app.config['GBD_SQLITE_MMAP_SIZE']}")
+    cursor.execute(f"PRAGMA cache_size = {app.config['GBD_SQLITE_CACHE_SIZE']}")
+    cursor.close()
+
+
+@event.listens_for(Engine, "savepoint")
+def begin_sqlite_savepoint(conn, name):
+    # pysqlite only begins a transaction before DML, a SAVEPOINT outside of
+    # one would begin it and its RELEASE would commit everything
+    dbapi_connection = conn.connection.connection
+    if (
+        isinstance(dbapi_connection, sqlite3.Connection)
+        and not dbapi_connection.in_transaction
+    ):
+        # the savepoint is taken to write
+        dbapi_connection.execute("BEGIN IMMEDIATE")
+
+
+def _set_query_only(dbapi_connection, connection_record):
+    dbapi_connection.execute("PRAGMA query_only = 1")
+
+
+def reader_engine(engine):
+    """Return the read-only engine for an engine, None if there is none."""
+    global _reader_engine, _reader_pid
+    if _reader_pid == os.getpid():
+        return _reader_engine
+
+    url = engine.url
+    pool_size = app.config["GBD_SQLITE_READER_POOL_SIZE"]
+    if url.get_backend_name() != "sqlite" or url.database in (None, "", ":memory:"):
+        pool_size = 0
+    _reader_engine = None
+    if pool_size:
+        _reader_engine = create_engine(
+            url,
+            poolclass=QueuePool,
+            pool_size=pool_size,
+            # pooled connections are handed to one thread at a time
+            connect_args={"check_same_thread": False},
+        )
+        event.listen(_reader_engine, "connect", _set_query_only)
+    _reader_pid = os.getpid()
+    return _reader_engine
+
+
+def read_only(view):
+    """Run the queries of a view on the read-only engine, if there is one."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_read_only = True
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+class RoutingSession(SignallingSession):
+    """Session that uses the read-only engine in read_only views."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_app_context() and g.get("db_read_only"):
+            # self.bind is the default engine
+            engine = reader_engine(self.bind)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class group_names(FunctionElement):
+    """Aggregate function joining names with commas."""
+
+    type = String()
+    name = "group_names"
+
+
+@compiles(group_names)
+def _compile_group_names(element, compiler, **kw):
+    return f"group_concat({compiler.process(element.clauses, **kw)}, ',')"
+
+
+@compiles(group_names, "mysql")
+def _compile_group_names_mysql(element, compiler, **kw):
+    return f"group_concat({compiler.process(element.clauses, **kw)} SEPARATOR ',')"
+
+
+@compiles(group_names, "postgresql")
+def _compile_group_names_postgresql(element, compiler, **kw):
+    return f"string_agg({compiler.process(element.clauses, **kw)}, ',')"
+
+
+def insert_ignore(table, dialect):
+    """Return an INSERT for a table that skips rows violating a unique key.
+
+    Arguments:
+    ---------
+        table : Table
+            the table to insert into.
+        dialect : Dialect
+            the dialect of the database the statement runs on.
+    """
+    if dialect.name == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect.name == "mysql":
+        return table.insert().prefix_with("IGNORE")
+    return table.insert().prefix_with("OR IGNORE")
@@ -0,0 +1,95 @@
+"""Buffered download counts.
+
+Counting a download used to mean a read-modify-write and a commit per
+request. Downloads are now collected in memory and written in batches with
+one atomic UPDATE by a background thread, either when enough of them piled
+up or after a while.
+"""
+import atexit
+import os
+import threading
+from collections import Counter
+
+from sqlalchemy import bindparam
+from sqlalchemy.exc import SQLAlchemyError
+
+from repo import app, db
+from repo.models import Plugin
+
+
+class DownloadCounter:
+    """Collects downloads per plugin and writes them to the database."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._pending = 0
+        # wakes the flush thread before the interval is over
+        self._wake = threading.Event()
+        # the flush thread doesn't survive a fork, remember who started it
+        self._pid = None
+
+    def add(self, plugin_id):
+        """Count a download of a plugin."""
+        with self._lock:
+            self._counts[plugin_id] += 1
+            self._pending += 1
+            pending = self._pending
+        self._start_flush_thread()
+        if pending >= app.config["GBD_DOWNLOAD_FLUSH_SIZE"]:
+            self._wake.set()
+
+    def flush(self):
+        """Write the collected downloads to the database."""
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+            self._pending = 0
+        if not counts:
+            return
+
+        plugin_table = Plugin.__table__
+        statement = (
+            plugin_table.update()
+            .where(plugin_table.c.id == bindparam("plugin_id"))
+            .values(
+                downloads=plugin_table.c.downloads + bindparam("count"),
+                # a download doesn't change the plugin
+                update_date=plugin_table.c.update_date,
+            )
+        )
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    statement,
+                    [
+                        {"plugin_id": plugin_id, "count": count}
+                        for plugin_id, count in counts.items()
+                    ],
+                )
+        except SQLAlchemyError as e:
+            app.logger.warning(f"writing download counts failed: {e}")
+            with self._lock:
+                self._counts.update(counts)
+                self._pending += sum(counts.values())
+
+    def _start_flush_thread(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._wake = threading.Event()
+        thread = threading.Thread(target=self._flush_periodically, daemon=True)
+        thread.start()
+
+    def _flush_periodically(self):
+        while True:
+            self._wake.wait(app.config["GBD_DOWNLOAD_FLUSH_INTERVAL"])
+            self._wake.clear()
+            self.flush()
+
+
+download_counter = DownloadCounter()
+# write what is left when the worker shuts down
+atexit.register(download_counter.flush)
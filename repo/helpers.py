@@ -1,10 +1,17 @@
 """Helper functions."""
 import hashlib
+import os
+import tempfile
+from collections import namedtuple
+from pathlib import Path
 
-from sqlalchemy.exc import OperationalError
+from packaging import version
 
+from repo import db
 from repo.models import Plugin, User
 
+Checksums = namedtuple("Checksums", ["md5", "sha256"])
+
 
 def readline_generator(fp):
     """Return a generator for readline."""
@@ -15,12 +22,9 @@ def readline_generator(fp):
 
 
 def db_is_populated():
-    """Check if our database is already populated."""
-    try:
-        Plugin.query.all()
-        return True
-    except OperationalError:
-        return False
+    """Check if our database is already populated, without reading any rows."""
+    with db.engine.connect() as connection:
+        return db.engine.dialect.has_table(connection, Plugin.__tablename__)
 
 
 def create_superuser():
@@ -59,3 +63,61 @@ def md5(file):
     while chunk := file.read(8192):
         hash_md5.update(chunk)
     return hash_md5.hexdigest()
+
+
+def spool_upload(stream, directory, sha256=True):
+    """Copy an uploaded file into a temporary file, hashing it on the way.
+
+    The upload is copied in chunks, so memory use doesn't depend on its size.
+    The temporary file is created in the given directory so it can later be
+    renamed into place atomically.
+
+    Arguments:
+    ---------
+        stream : file object
+            the uploaded file.
+        directory : Path
+            the directory to create the temporary file in.
+        sha256 : bool
+            also compute the sha256 hash of the file.
+
+    Returns the path of the temporary file and its Checksums.
+    """
+    hash_md5 = hashlib.md5()
+    hash_sha256 = hashlib.sha256() if sha256 else None
+    with tempfile.NamedTemporaryFile(
+        dir=directory, suffix=".part", delete=False
+    ) as spool_file:
+        try:
+            while chunk := stream.read(65536):
+                hash_md5.update(chunk)
+                if hash_sha256:
+                    hash_sha256.update(chunk)
+                spool_file.write(chunk)
+        except BaseException:
+            os.unlink(spool_file.name)
+            raise
+    # NamedTemporaryFile is only readable by us, plugins are served by nginx
+    os.chmod(spool_file.name, 0o644)
+    checksums = Checksums(
+        hash_md5.hexdigest(), hash_sha256.hexdigest() if hash_sha256 else None
+    )
+    return Path(spool_file.name), checksums
+
+
+def version_key(version_string: str):
+    """Return a sortable integer for a QGIS version string.
+
+    Major, minor and patch level are packed into one integer so version
+    ranges can be compared in SQL, e.g. "3.22.4" becomes 300220004.
+
+    Arguments:
+    ---------
+        version_string : str
+            the version to convert.
+
+    Raises packaging.version.InvalidVersion for strings that aren't versions.
+    """
+    release = version.parse(version_string).release + (0, 0)
+    major, minor, patch = (min(part, 9999) for part in release[:3])
+    return (major * 10000 + minor) * 10000 + patch
@@ -0,0 +1,114 @@
+"""Background processing of plugin uploads.
+
+With GBD_ASYNC_UPLOADS the spooled upload is handed to a thread pool of
+GBD_UPLOAD_WORKERS threads in the worker process and the request returns a
+job id right away. The state of the jobs is kept in the database, so any
+worker can answer a status request. A job that was still queued or running
+when its worker process died stays in that state.
+"""
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+from flask import copy_current_request_context
+from sqlalchemy.exc import SQLAlchemyError
+
+from repo import app, db, metrics
+from repo.helpers import Checksums
+from repo.models import UploadJob, User
+from repo.upload import plugin_upload
+
+_lock = threading.Lock()
+_executor = None
+# a thread pool doesn't survive a fork, remember who started it
+_executor_pid = None
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    with _lock:
+        if _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=app.config["GBD_UPLOAD_WORKERS"],
+                thread_name_prefix="upload",
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def enqueue_upload(user: User, package_path: Path, checksums: Checksums, file_name):
+    """Process an upload in the background and return its job.
+
+    Has to be called during a request, the job uses a copy of its context to
+    build URLs.
+
+    Arguments:
+    ---------
+        user : User
+            the uploading user.
+        package_path : Path
+            the spooled zip file, see upload.plugin_upload.
+        checksums : Checksums
+            the checksums of the zip file.
+        file_name : str
+            the name the file was uploaded with, shown in the job status.
+    """
+    job = UploadJob(id=uuid.uuid4().hex, user_id=user.id, file_name=file_name)
+    db.session.add(job)
+    db.session.commit()
+    job_id, user_id = job.id, user.id
+
+    @copy_current_request_context
+    def run():
+        _run_job(job_id, user_id, package_path, checksums)
+
+    try:
+        _get_executor().submit(run)
+    except RuntimeError:
+        # the pool is shutting down
+        package_path.unlink(missing_ok=True)
+        _finish_job(job_id, False, "upload queue is shut down")
+    metrics.inc("upload_jobs_total", status="queued")
+    return job
+
+
+def _run_job(job_id, user_id, package_path, checksums):
+    try:
+        UploadJob.query.filter_by(id=job_id).update({"status": "running"})
+        db.session.commit()
+        user = User.query.get(user_id)
+        success, result = plugin_upload(user, package_path, checksums)
+    except Exception:
+        app.logger.exception(f"upload job {job_id} failed")
+        db.session.rollback()
+        package_path.unlink(missing_ok=True)
+        success, result = False, "Error creating plugin. See logs for details."
+    _finish_job(job_id, success, result)
+
+
+def _finish_job(job_id, success, result):
+    job = UploadJob.query.get(job_id)
+    job.finished_at = datetime.utcnow()
+    if success:
+        job.status = "done"
+        job.plugin_id, job.plugin_version = result
+    else:
+        job.status = "failed"
+        job.message = result
+    try:
+        db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        app.logger.warning(f"updating upload job {job_id} failed: {e}")
+    metrics.inc("upload_jobs_total", status=job.status)
+
+
+def get_job(job_id, user):
+    """Return a job of the user, or any job for a superuser."""
+    job = UploadJob.query.get(job_id)
+    if job and (user.superuser or job.user_id == user.id):
+        return job
+    return None
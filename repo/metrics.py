@@ -0,0 +1,265 @@
+"""Timing instrumentation and a Prometheus style /metrics endpoint.
+
+Every worker process collects its counters and histograms in memory and
+regularly writes them to a file in GBD_METRICS_DIR. /metrics adds up the
+files of all workers, so it doesn't matter which worker answers the scrape.
+A worker removes its file when it exits, files of workers that died without
+doing so are removed at startup and by the next scrape.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from flask import Response, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from repo import app
+
+PREFIX = "gbd_plugin_repo_"
+
+# upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+
+HELP = {
+    "requests_total": "Handled requests.",
+    "request_duration_seconds": "Time spent handling a request.",
+    "db_queries_per_request": "Database queries run by a request.",
+    "db_query_duration_seconds_total": "Time spent in database queries.",
+    "request_db_duration_seconds": "Time spent in database queries by a request.",
+    "catalog_cache_requests_total": "Catalog lookups by cache result.",
+    "upload_bytes_total": "Size of uploaded plugin packages.",
+    "upload_phase_seconds": "Time spent in the phases of a plugin upload.",
+    "upload_jobs_total": "Background upload jobs by the status they reached.",
+}
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_last_write = 0
+
+
+def _label_string(labels):
+    return ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Increase a counter."""
+    key = _label_string(labels)
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+
+def observe(name, value, buckets=SECONDS_BUCKETS, **labels):
+    """Add a value to a histogram."""
+    key = _label_string(labels)
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = {
+                "le": list(buckets),
+                "buckets": [0] * len(buckets),
+                "sum": 0,
+                "count": 0,
+            }
+        for i, bound in enumerate(histogram["le"]):
+            if value <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observe the time spent in a block of code."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def snapshot():
+    """Return the metrics of this process."""
+    with _lock:
+        metrics = {"counters": _counters, "histograms": _histograms}
+        # a deep copy that can be written as is
+        return json.loads(json.dumps(metrics))
+
+
+def reset():
+    """Forget the metrics collected so far."""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def write_snapshot(force=False):
+    """Write the metrics of this process for the other workers to read."""
+    global _last_write
+    directory = app.config["GBD_METRICS_DIR"]
+    now = time.monotonic()
+    if not directory or (not force and now - _last_write < 1):
+        return
+    _last_write = now
+
+    path = Path(directory) / f"{os.getpid()}.json"
+    temp_path = path.with_name(f"{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        temp_path.write_text(json.dumps(snapshot()))
+        os.replace(temp_path, path)
+    except OSError as e:
+        app.logger.warning(f"writing metrics failed: {e}")
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # running as another user
+        return True
+    return True
+
+
+def remove_stale_snapshots():
+    """Remove the files of worker processes that are gone."""
+    directory = app.config["GBD_METRICS_DIR"]
+    for path in Path(directory).glob("*.json"):
+        if not path.stem.isdigit() or not _is_running(int(path.stem)):
+            path.unlink(missing_ok=True)
+
+
+@atexit.register
+def remove_snapshot():
+    """Remove the file of this process, its metrics end with it."""
+    directory = app.config["GBD_METRICS_DIR"]
+    if directory:
+        (Path(directory) / f"{os.getpid()}.json").unlink(missing_ok=True)
+
+
+def collect():
+    """Return the metrics of all worker processes, added up."""
+    directory = app.config["GBD_METRICS_DIR"]
+    if not directory:
+        return snapshot()
+
+    write_snapshot(force=True)
+    remove_stale_snapshots()
+    counters, histograms = {}, {}
+    for path in Path(directory).glob("*.json"):
+        try:
+            metrics = json.loads(path.read_text())
+        except (OSError, ValueError):
+            continue
+        for name, series in metrics["counters"].items():
+            total = counters.setdefault(name, {})
+            for key, value in series.items():
+                total[key] = total.get(key, 0) + value
+        for name, series in metrics["histograms"].items():
+            total = histograms.setdefault(name, {})
+            for key, histogram in series.items():
+                if key not in total:
+                    total[key] = histogram
+                    continue
+                total[key]["buckets"] = [
+                    a + b for a, b in zip(total[key]["buckets"], histogram["buckets"])
+                ]
+                total[key]["sum"] += histogram["sum"]
+                total[key]["count"] += histogram["count"]
+    return {"counters": counters, "histograms": histograms}
+
+
+def _sample(name, labels, value):
+    """Return a line of the text format."""
+    if labels:
+        return f"{PREFIX}{name}{{{labels}}} {value}"
+    return f"{PREFIX}{name} {value}"
+
+
+def render(metrics):
+    """Render metrics in the Prometheus text format."""
+    lines = []
+    for name, series in sorted(metrics["counters"].items()):
+        lines.append(f"# HELP {PREFIX}{name} {HELP.get(name, name)}")
+        lines.append(f"# TYPE {PREFIX}{name} counter")
+        for key, value in sorted(series.items()):
+            lines.append(_sample(name, key, value))
+    for name, series in sorted(metrics["histograms"].items()):
+        lines.append(f"# HELP {PREFIX}{name} {HELP.get(name, name)}")
+        lines.append(f"# TYPE {PREFIX}{name} histogram")
+        for key, histogram in sorted(series.items()):
+            bounds = histogram["le"] + ["+Inf"]
+            counts = histogram["buckets"] + [histogram["count"]]
+            for bound, count in zip(bounds, counts):
+                labels = ",".join(filter(None, [key, f'le="{bound}"']))
+                lines.append(_sample(f"{name}_bucket", labels, count))
+            lines.append(_sample(f"{name}_sum", key, histogram["sum"]))
+            lines.append(_sample(f"{name}_count", key, histogram["count"]))
+    return "\n".join(lines) + "\n"
+
+
+@app.before_request
+def start_request_timer():
+    g.metrics_started = time.perf_counter()
+    g.metrics_queries = 0
+    g.metrics_query_seconds = 0
+
+
+@app.after_request
+def observe_request(response):
+    started = g.get("metrics_started")
+    if started is not None:
+        endpoint = request.endpoint or "unknown"
+        observe(
+            "request_duration_seconds",
+            time.perf_counter() - started,
+            endpoint=endpoint,
+        )
+        observe(
+            "db_queries_per_request",
+            g.metrics_queries,
+            buckets=COUNT_BUCKETS,
+            endpoint=endpoint,
+        )
+        observe(
+            "request_db_duration_seconds",
+            g.metrics_query_seconds,
+            endpoint=endpoint,
+        )
+        inc("requests_total", endpoint=endpoint, status=response.status_code)
+        write_snapshot()
+    return response
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def observe_query(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info["metrics_started"].pop()
+    inc("db_query_duration_seconds_total", duration)
+    if has_app_context() and "metrics_queries" in g:
+        g.metrics_queries += 1
+        g.metrics_query_seconds += duration
+
+
+if app.config["GBD_METRICS_DIR"]:
+    os.makedirs(app.config["GBD_METRICS_DIR"], exist_ok=True)
+    remove_stale_snapshots()
+
+
+@app.route("/metrics")
+def get_metrics():
+    """Expose the collected metrics to Prometheus."""
+    return Response(render(collect()), mimetype="text/plain; version=0.0.4")
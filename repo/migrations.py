@@ -0,0 +1,132 @@
+"""Schema upgrades for databases created by older versions of the app."""
+from packaging.version import InvalidVersion
+from sqlalchemy import bindparam, inspect, select
+from sqlalchemy.exc import IntegrityError
+
+from repo import app, db
+from repo.helpers import version_key
+from repo.models import Plugin, PluginTombstone, SchemaVersion
+from repo.search import create_search_index
+
+# bump when adding an upgrade step, databases at this version skip upgrade_db
+SCHEMA_VERSION = 4
+
+# columns added to tables that already existed in older databases
+COLUMNS = [
+    Plugin.__table__.c.qgis_minimum_key,
+    Plugin.__table__.c.qgis_maximum_key,
+    Plugin.__table__.c.sha256_sum,
+    PluginTombstone.__table__.c.user_ids,
+]
+
+# indexes added to tables that already existed in older databases
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_plugin_update_date ON plugin (update_date)",
+    "CREATE INDEX IF NOT EXISTS ix_plugin_qgis_minimum_key "
+    "ON plugin (qgis_minimum_key)",
+    "CREATE INDEX IF NOT EXISTS ix_plugin_qgis_maximum_key "
+    "ON plugin (qgis_maximum_key)",
+    "CREATE INDEX IF NOT EXISTS ix_plugin_role_role_id ON plugin_role (role_id)",
+    "CREATE INDEX IF NOT EXISTS ix_user_role_role_id ON user_role (role_id)",
+    "CREATE INDEX IF NOT EXISTS ix_plugin_icon ON plugin (icon)",
+    "CREATE INDEX IF NOT EXISTS ix_plugin_name ON plugin (name)",
+    "CREATE INDEX IF NOT EXISTS ix_plugin_downloads ON plugin (downloads)",
+]
+
+
+def upgrade_db():
+    """Bring an existing database up to date with the models."""
+    if schema_version() >= SCHEMA_VERSION:
+        return
+
+    # create_all only creates tables that don't exist yet
+    db.create_all()
+
+    inspector = inspect(db.engine)
+    with db.engine.begin() as connection:
+        for column in COLUMNS:
+            existing = [c["name"] for c in inspector.get_columns(column.table.name)]
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                connection.execute(
+                    f"ALTER TABLE {column.table.name} "
+                    f"ADD COLUMN {column.name} {column_type}"
+                )
+        for statement in INDEXES:
+            connection.execute(statement)
+
+    create_checksum_index()
+    backfill_version_keys()
+    create_search_index()
+    stamp_schema_version()
+
+
+def schema_version():
+    """Return the schema version of the database, 0 if it predates them."""
+    table = SchemaVersion.__table__
+    with db.engine.connect() as connection:
+        if not db.engine.dialect.has_table(connection, table.name):
+            return 0
+        return connection.execute(select([table.c.version])).scalar() or 0
+
+
+def stamp_schema_version():
+    """Record that the database is at SCHEMA_VERSION."""
+    table = SchemaVersion.__table__
+    with db.engine.begin() as connection:
+        connection.execute(table.delete())
+        connection.execute(table.insert().values(id=1, version=SCHEMA_VERSION))
+
+
+def create_checksum_index():
+    """Make the md5 checksum of plugins unique, if the data allows it."""
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS ix_plugin_md5_sum "
+                "ON plugin (md5_sum)"
+            )
+    except IntegrityError:
+        app.logger.warning(
+            "duplicate plugin checksums in the database, md5_sum is not unique"
+        )
+        with db.engine.begin() as connection:
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_plugin_md5_sum ON plugin (md5_sum)"
+            )
+
+
+def backfill_version_keys():
+    """Compute the QGIS version keys of plugins uploaded before they existed."""
+    plugin_table = Plugin.__table__
+    rows = db.session.query(
+        Plugin.id, Plugin.qgisminimumversion, Plugin.qgismaximumversion
+    ).filter((Plugin.qgis_minimum_key.is_(None)) | (Plugin.qgis_maximum_key.is_(None)))
+
+    keys = []
+    for plugin_id, minimum_version, maximum_version in rows:
+        try:
+            keys.append(
+                {
+                    "plugin_id": plugin_id,
+                    "minimum_key": version_key(minimum_version),
+                    "maximum_key": version_key(maximum_version),
+                }
+            )
+        except InvalidVersion:
+            app.logger.warning(f"invalid QGIS version range for plugin {plugin_id}")
+    if not keys:
+        return
+
+    # keep update_date, the plugins themselves didn't change
+    statement = (
+        plugin_table.update()
+        .where(plugin_table.c.id == bindparam("plugin_id"))
+        .values(
+            qgis_minimum_key=bindparam("minimum_key"),
+            qgis_maximum_key=bindparam("maximum_key"),
+            update_date=plugin_table.c.update_date,
+        )
+    )
+    with db.engine.begin() as connection:
+        connection.execute(statement, keys)
@@ -1,5 +1,7 @@
 """Database Models."""
 from datetime import datetime
+from functools import cached_property
+from urllib.parse import quote
 
 from flask import url_for
 from flask_login import UserMixin
@@ -11,8 +13,13 @@ from repo import db
 plugin_role_permissions_association = db.Table(
     "plugin_role",
     db.Column("plugin_id", db.Integer, db.ForeignKey("plugin.id"), primary_key=True),
-    db.Column("role_id", db.Integer, db.ForeignKey("role.id"), primary_key=True),
+    db.Column(
+        "role_id", db.Integer, db.ForeignKey("role.id"), primary_key=True, index=True
+    ),
 )
+# columns used internally that aren't part of the published metadata
+INTERNAL_COLUMNS = {"qgis_minimum_key", "qgis_maximum_key", "sha256_sum"}
+
 plugin_tag_association = db.Table(
     "plugin_tag",
     db.Column("plugin_id", db.Integer, db.ForeignKey("plugin.id"), primary_key=True),
@@ -24,29 +31,34 @@ class Plugin(db.Model):
     """Model for our QGIS Plugins."""
 
     id = db.Column(db.Integer, primary_key=True)
-    md5_sum = db.Column(db.String(32), nullable=False)
+    md5_sum = db.Column(db.String(32), nullable=False, unique=True, index=True)
+    sha256_sum = db.Column(db.String(64))
     file_name = db.Column(db.String(120), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     create_date = db.Column(db.DateTime(), default=datetime.utcnow())
     update_date = db.Column(
-        db.DateTime(), default=datetime.utcnow, onupdate=datetime.utcnow
+        db.DateTime(), default=datetime.utcnow, onupdate=datetime.utcnow, index=True
     )
     public = db.Column(db.Boolean(), default=True)
+    # loaded on demand, catalog queries choose their own loading strategy
     roles = db.relationship(
         "Role",
         secondary=plugin_role_permissions_association,
-        lazy="subquery",
+        lazy=True,
         backref=db.backref("plugins", lazy=True),
     )
     trusted = db.Column(db.Boolean(), default=True)
     average_votes = db.Column(db.Float(), default=0)
     rating_votes = db.Column(db.Integer(), default=0)
-    downloads = db.Column(db.Integer(), default=0)
+    downloads = db.Column(db.Integer(), default=0, index=True)
 
     # values from metadata.txt
-    name = db.Column(db.String(120), nullable=False)
+    name = db.Column(db.String(120), nullable=False, index=True)
     qgisminimumversion = db.Column(db.String(10), nullable=False)
     qgismaximumversion = db.Column(db.String(10), nullable=False, default="3.99")
+    # the versions above as sortable integers, see helpers.version_key
+    qgis_minimum_key = db.Column(db.Integer(), index=True)
+    qgis_maximum_key = db.Column(db.Integer(), index=True)
     description = db.Column(db.String(200), nullable=False)
     about = db.Column(db.String(), nullable=False)
     version = db.Column(db.String(10), nullable=False)
@@ -61,10 +73,10 @@ class Plugin(db.Model):
     tags = db.relationship(
         "Tag",
         secondary=plugin_tag_association,
-        lazy="subquery",
+        lazy=True,
         backref=db.backref("plugins", lazy=True),
     )
-    icon = db.Column(db.String(120))
+    icon = db.Column(db.String(120), index=True)
     plugin_dependencies = db.Column(db.String())
     server = db.Column(db.Boolean(), default=False)
     hasprocessingprovider = db.Column(db.Boolean(), default=False)
@@ -76,54 +88,109 @@ class Plugin(db.Model):
             f"Plugin: {self.name}, version {self.version}, zip_file: {self.file_name}"
         )
 
-    def to_xml(self):
-        plugin_element = etree.Element(
-            "pyqgis_plugin", version=self.version, name=self.name
-        )
-        for c_name in [c.name for c in self.__table__.columns]:
-            if c_name == "plugin_dependencies":
-                element_name = "external_dependencies"
-            elif c_name == "qgisminimumversion":
-                element_name = "qgis_minimum_version"
-            elif c_name == "qgismaximumversion":
-                element_name = "qgis_maximum_version"
-            elif c_name == "user_id":
-                element_name = "uploaded_by"
-            else:
-                element_name = c_name
-
-            sub_element = etree.SubElement(plugin_element, element_name)
-
-            if c_name == "plugin_dependencies" and not self.plugin_dependencies:
-                continue
-            elif c_name == "user_id":
-                sub_element.text = self.user.name
-            else:
-                sub_element.text = str(getattr(self, c_name))
-
-        # custom
-        url_element = etree.SubElement(plugin_element, "download_url")
-        url_element.text = url_for(
-            "download_plugin", filename=self.file_name, _external=True
-        )
+    def to_xml(self, download_url=None):
+        """Serialize the plugin into a pyqgis_plugin element."""
+        return next(serialize_plugins([self], download_url))
 
-        tags_element = etree.SubElement(plugin_element, "tags")
-        tags_element.text = ",".join([str(t) for t in self.tags])
+    @property
+    def uploader_name(self):
+        return self.user.name
 
-        return plugin_element
+    @property
+    def tag_names(self):
+        return ",".join([str(t) for t in self.tags])
+
+    @property
+    def role_ids(self):
+        """Return the ids of the roles with access to the plugin."""
+        return {role.id for role in self.roles}
 
     def has_access(self, user):
-        return (
-            self.public
-            or (user.is_authenticated and user.superuser)
-            or (user.is_authenticated and set(self.roles).intersection(set(user.roles)))
+        """Check if the user may see and download the plugin."""
+        if self.public:
+            return True
+        if not user.is_authenticated:
+            return False
+        return user.superuser or not user.role_ids.isdisjoint(self.role_ids)
+
+
+def _optional_text(value):
+    return str(value) if value else None
+
+
+# columns that are published under another name or come from a relation
+XML_ELEMENT_NAMES = {
+    "plugin_dependencies": "external_dependencies",
+    "qgisminimumversion": "qgis_minimum_version",
+    "qgismaximumversion": "qgis_maximum_version",
+    "user_id": "uploaded_by",
+}
+XML_ATTRIBUTES = {"user_id": "uploader_name"}
+XML_FORMATTERS = {"plugin_dependencies": _optional_text}
+
+# how to serialize a plugin: (attribute, element name, formatter) per element
+XML_FIELDS = tuple(
+    (
+        XML_ATTRIBUTES.get(c.name, c.name),
+        XML_ELEMENT_NAMES.get(c.name, c.name),
+        XML_FORMATTERS.get(c.name, str),
+    )
+    for c in Plugin.__table__.columns
+    if c.name not in INTERNAL_COLUMNS
+)
+# the columns needed by serialize_plugins, besides uploader_name and tag_names
+XML_COLUMNS = tuple(
+    getattr(Plugin, c.name)
+    for c in Plugin.__table__.columns
+    if c.name not in INTERNAL_COLUMNS
+)
+
+
+def download_url_prefix():
+    """Return the download URL of plugins without the file name."""
+    return url_for("download_plugin", filename="-", _external=True)[:-1]
+
+
+def plugin_download_url(prefix, file_name):
+    """Return the download URL of a plugin file, quoted like url_for does."""
+    return prefix + quote(file_name, safe="!$&'()*+,/:;=@")
+
+
+def serialize_plugins(rows, download_url=None):
+    """Serialize plugins into pyqgis_plugin elements, one at a time.
+
+    Arguments:
+    ---------
+        rows : iterable
+            Plugin instances or query rows with the XML_COLUMNS plus
+            uploader_name and tag_names.
+        download_url : str
+            the download URL without the file name, built from the current
+            request if not given.
+    """
+    if download_url is None:
+        download_url = download_url_prefix()
+    element = etree.Element
+    sub_element = etree.SubElement
+    for row in rows:
+        plugin_element = element("pyqgis_plugin", version=row.version, name=row.name)
+        for attribute, element_name, formatter in XML_FIELDS:
+            sub_element(plugin_element, element_name).text = formatter(
+                getattr(row, attribute)
+            )
+        sub_element(plugin_element, "download_url").text = plugin_download_url(
+            download_url, row.file_name
         )
+        sub_element(plugin_element, "tags").text = row.tag_names
+        yield plugin_element
 
 
 user_role_association = db.Table(
     "user_role",
     db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
-    db.Column("role_id", db.Integer, db.ForeignKey("role.id"), primary_key=True),
+    db.Column(
+        "role_id", db.Integer, db.ForeignKey("role.id"), primary_key=True, index=True
+    ),
 )
 
 
@@ -150,6 +217,11 @@ class User(UserMixin, db.Model):
         """Check the users password."""
         return check_password_hash(self.password_hash, password)
 
+    @cached_property
+    def role_ids(self):
+        """Return the ids of the users roles, cached for this instance."""
+        return frozenset(role.id for role in self.roles)
+
     def can_upload(self):
         """Check if can upload."""
         return "upload" in [r.name for r in self.roles] or self.superuser
@@ -167,3 +239,94 @@ class Tag(db.Model):
     def __repr__(self):
         """Show a Representation of the Tag."""
         return f"{self.name}"
+
+
+class PluginTombstone(db.Model):
+    """Record of a plugin that disappeared from the catalog of some users.
+
+    Written when a plugin is deleted or its access is restricted, so mirrors
+    syncing with /plugins/changes.xml learn about it.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    plugin_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(120), nullable=False)
+    file_name = db.Column(db.String(120), nullable=False)
+    # who could see the plugin before
+    public = db.Column(db.Boolean(), nullable=False)
+    role_ids = db.Column(db.String(), nullable=False, default="")
+    # users that lost access by losing a role or the superuser flag
+    user_ids = db.Column(db.String(), default="")
+    deleted_at = db.Column(db.DateTime(), default=datetime.utcnow, index=True)
+
+    def has_access(self, user):
+        """Check if the user could see the plugin before."""
+        if self.public:
+            return True
+        if not user.is_authenticated:
+            return False
+        role_ids = {int(role_id) for role_id in self.role_ids.split(",") if role_id}
+        user_ids = {
+            int(user_id) for user_id in (self.user_ids or "").split(",") if user_id
+        }
+        return (
+            user.superuser
+            or user.id in user_ids
+            or not user.role_ids.isdisjoint(role_ids)
+        )
+
+    def to_xml(self):
+        return etree.Element(
+            "deleted_plugin",
+            id=str(self.plugin_id),
+            name=self.name,
+            file_name=self.file_name,
+            deleted_at=self.deleted_at.isoformat(),
+        )
+
+
+class CatalogState(db.Model):
+    """Single row that changes whenever the published catalog changes."""
+
+    id = db.Column(db.Integer, primary_key=True)
+    generation = db.Column(db.Integer, nullable=False, default=0)
+    changed_at = db.Column(db.DateTime(), default=datetime.utcnow)
+
+
+class UploadJob(db.Model):
+    """A plugin upload processed in the background, see repo.jobs."""
+
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    file_name = db.Column(db.String(255))
+    # queued, running, done or failed
+    status = db.Column(db.String(10), nullable=False, default="queued")
+    # the error message of a failed upload
+    message = db.Column(db.String())
+    plugin_id = db.Column(db.Integer)
+    plugin_version = db.Column(db.String(10))
+    created_at = db.Column(db.DateTime(), default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime())
+
+    def to_dict(self):
+        """Return the state of the job, without empty values for XML-RPC."""
+        job = {
+            "id": self.id,
+            "status": self.status,
+            "file_name": self.file_name or "",
+            "created_at": self.created_at.isoformat(),
+        }
+        if self.finished_at:
+            job["finished_at"] = self.finished_at.isoformat()
+        if self.status == "done":
+            job["result"] = [self.plugin_id, self.plugin_version]
+        elif self.status == "failed":
+            job["result"] = self.message
+        return job
+
+
+class SchemaVersion(db.Model):
+    """Single row holding the version of the schema, see repo.migrations."""
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
@@ -1,21 +1,59 @@
 """End points for Plugins."""
+import base64
 import io
+import json
+import mimetypes
+import re
+from datetime import datetime, timezone
 from pathlib import Path
-
-from flask import (Response, abort, flash, redirect, render_template, request,
-                   send_from_directory, url_for)
+from urllib.parse import quote
+
+from flask import (
+    Response,
+    abort,
+    flash,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    send_from_directory,
+    stream_with_context,
+    url_for,
+)
 from flask_login import current_user, login_required
 from lxml import etree
-from packaging import version
-from sqlalchemy import or_
-
-from repo import app, db, rpc_handler
-from repo.models import Plugin, Role, User
+from packaging.version import InvalidVersion
+from werkzeug.http import is_resource_modified
+
+from repo import app, db, metrics, rpc_handler
+from repo.catalog import (
+    ENCODERS,
+    JSON_FIELDS,
+    LISTING_SORTS,
+    add_tombstone,
+    catalog_changes,
+    catalog_etag,
+    current_version,
+    get_catalog,
+    invalidate_catalog,
+    plugin_listing,
+    stream_catalog,
+    visible_plugins,
+)
+from repo.database import read_only
+from repo.downloads import download_counter
+from repo.helpers import spool_upload, version_key
+from repo.jobs import enqueue_upload, get_job
+from repo.models import Plugin, Role, serialize_plugins
 from repo.rpc import RPCError
-from repo.upload import plugin_upload
+from repo.search import search_plugins, unindex_plugins
+from repo.upload import plugin_dir, plugin_upload, plugin_upload_many
 
 plugin_ns = rpc_handler.namespace("plugin")
 
+# icons stored by upload.store_icon
+CONTENT_ADDRESSED_ICON = re.compile(r"^[0-9a-f]{64}\.\w+$")
+
 
 @plugin_ns.register
 def upload(package):
@@ -23,8 +61,15 @@ def upload(package):
     if not current_user.superuser:
         raise RPCError("user not authorized to upload plugins!")
 
-    package_file = io.BytesIO(package.data)
-    success, result = plugin_upload(current_user, package_file)
+    # xmlrpc already decoded the whole package, BytesIO doesn't copy it
+    with metrics.timer("upload_phase_seconds", phase="hash"):
+        package_path, checksums = spool_upload(
+            io.BytesIO(package.data), plugin_dir(), app.config["GBD_PLUGIN_SHA256"]
+        )
+    if app.config["GBD_ASYNC_UPLOADS"]:
+        # poll plugin.upload_status with the job id for the result
+        return enqueue_upload(current_user, package_path, checksums, None).id
+    success, result = plugin_upload(current_user, package_path, checksums)
 
     if success:
         return result
@@ -32,6 +77,39 @@ def upload(package):
         raise RPCError(result)
 
 
+@plugin_ns.register
+def upload_many(packages):
+    """XML RPC function to upload several QGIS plugins in one transaction.
+
+    Returns a struct with success and result, the plugin id and version or
+    the error, per package.
+    """
+    if not current_user.superuser:
+        raise RPCError("user not authorized to upload plugins!")
+
+    spooled = []
+    with metrics.timer("upload_phase_seconds", phase="hash"):
+        for package in packages:
+            spooled.append(
+                spool_upload(
+                    io.BytesIO(package.data),
+                    plugin_dir(),
+                    app.config["GBD_PLUGIN_SHA256"],
+                )
+            )
+    results = plugin_upload_many(current_user, spooled)
+    return [{"success": success, "result": result} for success, result in results]
+
+
+@plugin_ns.register
+def upload_status(job_id):
+    """XML RPC function to get the state of an upload job."""
+    job = get_job(job_id, current_user)
+    if not job:
+        raise RPCError("unknown upload job!")
+    return job.to_dict()
+
+
 @app.route("/upload", methods=["GET", "POST"])
 @login_required
 def upload_plugin():
@@ -44,30 +122,60 @@ def upload_plugin():
             flash("no file part")
             app.logger.info(request.files)
             return redirect(url_for("upload_plugin"))
-        file = request.files["file"]
+        files = request.files.getlist("file")
 
         # check if the filename is emtpy
-        if file.filename == "":
+        if any(file.filename == "" for file in files):
             flash("no selected file")
             return redirect(url_for("upload_plugin"))
 
         # Check filetype
-        if not file.filename.endswith(".zip"):
+        if not all(file.filename.endswith(".zip") for file in files):
             flash("wrong filetype")
             return redirect(url_for("upload_plugin"))
 
-        package_file = io.BytesIO(file.read())
-        success, result = plugin_upload(current_user, package_file)
+        spooled = []
+        with metrics.timer("upload_phase_seconds", phase="hash"):
+            for file in files:
+                spooled.append(
+                    spool_upload(
+                        file.stream, plugin_dir(), app.config["GBD_PLUGIN_SHA256"]
+                    )
+                )
 
-        if success:
-            flash(f"uploaded {file.filename}")
-        else:
-            flash(result)
+        if app.config["GBD_ASYNC_UPLOADS"]:
+            for file, (package_path, checksums) in zip(files, spooled):
+                job = enqueue_upload(
+                    current_user, package_path, checksums, file.filename
+                )
+                flash(
+                    f"queued {file.filename}, status: "
+                    + url_for("get_upload_job", job_id=job.id, _external=True)
+                )
+            return redirect(url_for("upload_plugin"))
+        results = plugin_upload_many(current_user, spooled)
+
+        for file, (success, result) in zip(files, results):
+            if success:
+                flash(f"uploaded {file.filename}")
+            else:
+                flash(result)
         return redirect(url_for("upload_plugin"))
     else:
         return render_template("upload.html")
 
 
+@app.route("/upload/jobs/<job_id>")
+@login_required
+@read_only
+def get_upload_job(job_id):
+    """Return the state of an upload job as JSON."""
+    job = get_job(job_id, current_user)
+    if not job:
+        abort(404)
+    return jsonify(job.to_dict())
+
+
 @app.route("/plugins/<int:plugin_id>/delete")
 @login_required
 def delete_plugin(plugin_id):
@@ -77,61 +185,219 @@ def delete_plugin(plugin_id):
     p = Plugin.query.get(plugin_id)
     if not p:
         return abort(404)
+    add_tombstone(p, p.public, p.role_ids)
+    unindex_plugins([p.id])
     db.session.delete(p)
     db.session.commit()
-    full_path = (
-        Path(app.root_path) / Path(app.config["GBD_PLUGIN_PATH"]) / Path(p.file_name)
-    )
+    invalidate_catalog()
+    full_path = plugin_dir() / Path(p.file_name)
     full_path.unlink()
     app.logger.info(f"PLUGIN_DELETED: {p.name}({p.id}) by user {current_user.name}")
     return redirect(url_for("get_plugins"))
 
 
 @app.route("/plugins.xml")
+@app.route("/plugins.json")
 @app.route("/")
+@read_only
 def get_plugins():
-    """Generate the 'plugins.xml' and html view from the DB."""
-    if current_user.is_anonymous:
-        plugins = Plugin.query.filter_by(public=True).all()
-    elif current_user.superuser:
-        plugins = Plugin.query.all()
-    else:
-        plugins = (
-            Plugin.query.join(Plugin.roles, isouter=True)
-            .join(Role.users, isouter=True)
-            .filter(
-                or_(
-                    User.id == current_user.id,
-                    Plugin.public,
-                )
-            )
-            .all()
+    """Generate the 'plugins.xml', 'plugins.json' and html view from the DB."""
+    if request.path.endswith("plugins.xml"):
+        return catalog_response("text/xml")
+    if request.path.endswith("plugins.json"):
+        return catalog_response("application/json", json_fields_arg())
+
+    sort = request.args.get("sort", "name")
+    if sort not in LISTING_SORTS:
+        abort(400)
+    page_size = app.config["GBD_PAGE_SIZE"]
+    # one more than shown tells if there is a next page
+    plugins = plugin_listing(
+        current_user, sort, listing_cursor_arg(sort), qgis_version_arg(), page_size + 1
+    ).all()
+
+    next_page = None
+    if len(plugins) > page_size:
+        plugins = plugins[:page_size]
+        last = plugins[-1]
+        value = getattr(last, {"date": "update_date"}.get(sort, sort))
+        next_page = url_for(
+            "get_plugins",
+            sort=sort,
+            after=listing_cursor(value, last.id),
+            qgis=request.args.get("qgis"),
         )
+    return render_template(
+        "plugins.html",
+        plugins=plugins,
+        user=current_user,
+        sort=sort,
+        next_page=next_page,
+    )
 
-    if request.args.get("qgis"):
-        version_arg = request.args.get("qgis")
-        plugins = [
-            p
-            for p in plugins
-            if version.parse(p.qgisminimumversion) <= version.parse(version_arg)
-            and version.parse(p.qgismaximumversion) >= version.parse(version_arg)
-        ]
-
-    if request.path.endswith("plugins.xml"):
-        plugin_root = etree.Element("plugins")
 
-        for p in plugins:
-            plugin_root.append(p.to_xml())
+def listing_cursor(value, plugin_id):
+    """Return the ?after= argument continuing the listing after a plugin."""
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    token = json.dumps([value, plugin_id]).encode()
+    return base64.urlsafe_b64encode(token).decode()
+
+
+def listing_cursor_arg(sort):
+    """Return the ?after= argument as sort value and id, None if there is none."""
+    if not request.args.get("after"):
+        return None
+    try:
+        value, plugin_id = json.loads(base64.urlsafe_b64decode(request.args["after"]))
+    except (ValueError, TypeError):
+        abort(400)
+    # dates are ISO strings, bool is an int but not a download count
+    value_type = int if sort == "downloads" else str
+    if type(value) is not value_type or type(plugin_id) is not int:
+        abort(400)
+    if sort == "date":
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            abort(400)
+    return value, plugin_id
+
+
+def qgis_version_arg():
+    """Return the ?qgis= argument as version key, None if there is none."""
+    if not request.args.get("qgis"):
+        return None
+    try:
+        return version_key(request.args.get("qgis"))
+    except InvalidVersion:
+        abort(400)
+
+
+def json_fields_arg():
+    """Return the ?fields= argument as tuple of JSON_FIELDS, all if not given."""
+    if not request.args.get("fields"):
+        return tuple(JSON_FIELDS)
+    fields = set(request.args["fields"].split(","))
+    if not fields <= JSON_FIELDS.keys():
+        abort(400)
+    # the same fields in any order share a cached catalog
+    return tuple(field for field in JSON_FIELDS if field in fields)
+
+
+def catalog_response(mimetype, fields=None):
+    """Answer a catalog request, with a 304 if the client is up to date.
+
+    Arguments:
+    ---------
+        mimetype : str
+            the type of the catalog.
+        fields : tuple
+            the fields of a JSON catalog, None for plugins.xml.
+    """
+    qgis_key = qgis_version_arg()
+    # only plugins.xml is big enough to be streamed
+    streaming = app.config["GBD_CATALOG_STREAMING"] and fields is None
+    encoding = request.accept_encodings.best_match(
+        list(ENCODERS) + ["identity"], default="identity"
+    )
+    if encoding == "identity" or streaming:
+        encoding = None
+    catalog_version = current_version()
+    etag = catalog_etag(catalog_version, current_user, qgis_key, encoding, fields)
+
+    if is_resource_modified(
+        request.environ, etag=etag, last_modified=catalog_version.last_modified
+    ):
+        if streaming:
+            catalog = stream_with_context(stream_catalog(current_user, qgis_key))
+        else:
+            catalog = get_catalog(
+                current_user, qgis_key, catalog_version, encoding, fields
+            )
+        response = Response(catalog, mimetype=mimetype)
+        response.content_encoding = encoding
+    else:
+        metrics.inc("catalog_cache_requests_total", result="not_modified")
+        response = Response(status=304)
 
-        return Response(etree.tostring(plugin_root), mimetype="text/xml")
+    response.set_etag(etag, weak=True)
+    response.last_modified = catalog_version.last_modified
+    # shared caches may only keep the catalog everybody gets
+    if current_user.is_anonymous:
+        response.cache_control.public = True
     else:
-        roles = Role.query.all()
-        return render_template(
-            "plugins.html", plugins=plugins, user=current_user, roles=roles
+        response.cache_control.private = True
+    response.cache_control.max_age = app.config["GBD_CATALOG_MAX_AGE"]
+    response.cache_control.must_revalidate = True
+    response.vary.add("Authorization")
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+@app.route("/plugins/changes.xml")
+@read_only
+def get_plugin_changes():
+    """List the catalog changes since the cursor given as ?since=.
+
+    Mirrors keep the `next` attribute of the result and pass it as ?since=
+    in their next request, without it the whole catalog is listed. They
+    should remove the plugins listed as deleted_plugin and apply the updated
+    ones. Plugins the user can still see are never listed as deleted.
+    """
+    since = request.args.get("since")
+    if since:
+        try:
+            since = datetime.fromisoformat(since)
+        except ValueError:
+            abort(400)
+        if since.tzinfo:
+            # cursors are naive UTC like the dates in the database
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    plugins, tombstones, cursor = catalog_changes(current_user, since or None)
+
+    plugin_root = etree.Element("plugins")
+    if since:
+        plugin_root.set("since", since.isoformat())
+    if cursor:
+        plugin_root.set("next", cursor.isoformat())
+    for t in tombstones:
+        plugin_root.append(t.to_xml())
+    plugin_root.extend(serialize_plugins(plugins))
+    return Response(etree.tostring(plugin_root), mimetype="text/xml")
+
+
+@app.route("/search.json")
+@app.route("/search")
+@read_only
+def search():
+    """Search the plugins visible to the user, as HTML or JSON."""
+    terms = request.args.get("q", "")
+    plugins = search_plugins(current_user, terms, app.config["GBD_SEARCH_LIMIT"])
+    if request.path.endswith(".json"):
+        return jsonify(
+            [
+                {
+                    "id": p.id,
+                    "name": p.name,
+                    "version": p.version,
+                    "description": p.description,
+                    "author": p.author,
+                    "url": url_for("get_plugin", plugin_id=p.id, _external=True),
+                    "download_url": url_for(
+                        "download_plugin", filename=p.file_name, _external=True
+                    ),
+                }
+                for p in plugins
+            ]
         )
+    return render_template(
+        "plugins.html", plugins=plugins, user=current_user, search_terms=terms
+    )
 
 
 @app.route("/plugin/<int:plugin_id>")
+@read_only
 def get_plugin(plugin_id):
     plugin = Plugin.query.get(plugin_id)
     roles = Role.query.all()
@@ -157,6 +423,8 @@ def edit_plugin(plugin_id):
         return abort(403)
 
     changed = False
+    was_public = plugin.public
+    old_role_ids = plugin.role_ids
     roles = Role.query.all()
     for role in roles:
         should_have_access = request.form.get(f"role_{role.id}") == "on"
@@ -202,8 +470,14 @@ def edit_plugin(plugin_id):
         )
 
     if changed:
+        # changing the roles alone doesn't update the plugin row
+        plugin.update_date = datetime.utcnow()
+        if not plugin.public and (was_public or old_role_ids - plugin.role_ids):
+            # let mirrors of users that lost access remove the plugin
+            add_tombstone(plugin, was_public, old_role_ids, plugin.update_date)
         db.session.add(plugin)
         db.session.commit()
+        invalidate_catalog()
         flash(f"successfuly changed plugin: {plugin.name}")
     else:
         flash("no changes were made")
@@ -211,32 +485,75 @@ def edit_plugin(plugin_id):
     return redirect(url_for("get_plugin", plugin_id=plugin.id))
 
 
+def send_plugin_file(directory, filename, accel_location):
+    """Send a file, or let nginx send it if X-Accel-Redirect is enabled.
+
+    Arguments:
+    ---------
+        directory : Path
+            the directory the file is in.
+        filename : str
+            the name of the file.
+        accel_location : str
+            the internal nginx location serving the directory.
+    """
+    if not app.config["GBD_X_ACCEL_REDIRECT"]:
+        return send_from_directory(directory, filename)
+
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    response = Response(mimetype=mimetype)
+    response.headers["X-Accel-Redirect"] = accel_location + quote(filename)
+    return response
+
+
 @app.route("/download/<string:filename>")
+@read_only
 def download_plugin(filename):
     plugin = Plugin.query.filter(Plugin.file_name == filename).first()
-    full_path = Path(app.root_path) / app.config["GBD_PLUGIN_PATH"]
 
     if plugin:
         if plugin.has_access(current_user):
-            plugin.downloads += 1
-            db.session.add(plugin)
-            db.session.commit()
-            return send_from_directory(full_path, plugin.file_name)
+            download_counter.add(plugin.id)
+            return send_plugin_file(
+                plugin_dir(),
+                plugin.file_name,
+                app.config["GBD_ACCEL_PLUGIN_LOCATION"],
+            )
         else:
             abort(403)
     abort(404)
 
 
 @app.route("/icons/<string:filename>")
+@read_only
 def get_icon(filename):
-    plugin = Plugin.query.filter(Plugin.icon == request.path).first()
-    if plugin:
-        if plugin.has_access(current_user):
-            full_path = Path(app.root_path) / app.config["GBD_ICON_PATH"]
-            return send_from_directory(full_path, filename)
-        else:
+    # an icon may be shared by several plugins, one of them is enough
+    visible = (
+        visible_plugins(current_user)
+        .filter(Plugin.icon == request.path)
+        .with_entities(Plugin.public)
+        .order_by(Plugin.public.desc())
+        .first()
+    )
+    if not visible:
+        if db.session.query(Plugin.id).filter(Plugin.icon == request.path).first():
             abort(403)
-    abort(404)
+        abort(404)
+
+    full_path = Path(app.root_path) / app.config["GBD_ICON_PATH"]
+    response = send_plugin_file(
+        full_path, filename, app.config["GBD_ACCEL_ICON_LOCATION"]
+    )
+    if CONTENT_ADDRESSED_ICON.match(filename):
+        # named by the hash of the content, the file never changes
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = app.config["GBD_ICON_MAX_AGE"]
+        response.cache_control.immutable = True
+        if visible.public:
+            response.cache_control.public = True
+        else:
+            response.cache_control.private = True
+    return response
 
 
 @app.route("/howto")
@@ -0,0 +1,148 @@
+"""Full-text search over plugins with an SQLite FTS5 index.
+
+The plugin_search virtual table holds the searchable text of every plugin
+under the plugin id as rowid. Uploads and deletes keep it up to date in their
+own transaction. Visibility isn't part of the index, searches are joined with
+catalog.visible_plugins like every other listing.
+"""
+import re
+
+from sqlalchemy import (
+    Column,
+    Integer,
+    MetaData,
+    Table,
+    Text,
+    func,
+    literal_column,
+    select,
+)
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import joinedload, selectinload
+
+from repo import app, db
+from repo.catalog import visible_plugins
+from repo.models import Plugin, User
+
+# searchable fields and their weight in the ranking
+SEARCH_WEIGHTS = {
+    "name": 10.0,
+    "tags": 5.0,
+    "description": 3.0,
+    "author": 2.0,
+    "about": 1.0,
+}
+
+_available = None
+
+# not part of db.metadata, create_all can't create virtual tables
+search_table = Table(
+    "plugin_search",
+    MetaData(),
+    Column("rowid", Integer, primary_key=True),
+    *[Column(name, Text) for name in SEARCH_WEIGHTS],
+)
+
+
+def create_search_index():
+    """Create and fill the search index if it doesn't exist yet."""
+    columns = ", ".join(SEARCH_WEIGHTS)
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS plugin_search "
+                f"USING fts5({columns}, tokenize='unicode61 remove_diacritics 2')"
+            )
+    except OperationalError as e:
+        app.logger.warning(f"full-text search is not available: {e}")
+        return
+    if not db.session.query(search_table.c.rowid).first():
+        index_plugins(Plugin.query.options(selectinload(Plugin.tags)))
+        db.session.commit()
+
+
+def search_available():
+    """Check if the database has the search index, once per process."""
+    global _available
+    if _available is None:
+        with db.engine.connect() as connection:
+            _available = db.engine.dialect.has_table(connection, search_table.name)
+    return _available
+
+
+def index_plugins(plugins):
+    """Add plugins to the search index or update them, in the current session.
+
+    Arguments:
+    ---------
+        plugins : iterable
+            Plugin instances with their ids assigned, i.e. flushed.
+    """
+    if not search_available():
+        return
+    rows = [
+        {
+            "rowid": plugin.id,
+            "name": plugin.name,
+            "tags": " ".join(tag.name for tag in plugin.tags),
+            "description": plugin.description,
+            "author": plugin.author,
+            "about": plugin.about,
+        }
+        for plugin in plugins
+    ]
+    if not rows:
+        return
+    unindex_plugins([row["rowid"] for row in rows])
+    db.session.execute(search_table.insert(), rows)
+
+
+def unindex_plugins(plugin_ids):
+    """Remove plugins from the search index, in the current session."""
+    if not search_available():
+        return
+    db.session.execute(
+        search_table.delete().where(search_table.c.rowid.in_(plugin_ids))
+    )
+
+
+def match_expression(terms):
+    """Turn user input into an FTS5 query.
+
+    Every word has to match, as a prefix of a word in the plugin. Quoting the
+    words keeps FTS5 operators in the input from being interpreted.
+    """
+    words = re.findall(r"\w+", terms)
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def search_plugins(user, terms, limit=50):
+    """Return the plugins visible to the user matching terms, best first.
+
+    Arguments:
+    ---------
+        user : User
+            the searching user.
+        terms : str
+            the search terms as entered by the user.
+        limit : int
+            the maximum number of plugins returned.
+    """
+    expression = match_expression(terms)
+    if not expression or not search_available():
+        return []
+    table = literal_column(search_table.name)
+    rank = func.bm25(table, *SEARCH_WEIGHTS.values())
+    matches = (
+        select([search_table.c.rowid.label("plugin_id"), rank.label("rank")])
+        .where(table.match(expression))
+        .alias("matches")
+    )
+    return (
+        visible_plugins(user)
+        .options(joinedload(Plugin.user).lazyload(User.roles))
+        .join(matches, matches.c.plugin_id == Plugin.id)
+        .order_by(matches.c.rank)
+        .limit(limit)
+        .all()
+    )
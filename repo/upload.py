@@ -1,4 +1,10 @@
-import io
+import hashlib
+import os
+import re
+import threading
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 from configparser import Error as ConfigParserError
 from pathlib import Path
@@ -6,108 +12,447 @@ from zipfile import BadZipFile, ZipFile
 
 from flask import url_for
 from packaging import version
-from sqlalchemy.exc import SQLAlchemyError
+from packaging.version import InvalidVersion
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import make_transient_to_detached
 from sqlalchemy.sql import sqltypes
 
-from repo import app, db
-from repo.helpers import md5, readline_generator
+from repo import app, db, metrics
+from repo.catalog import (
+    add_tombstone,
+    clear_cache,
+    invalidate_catalog,
+    mark_catalog_changed,
+)
+from repo.database import insert_ignore
+from repo.helpers import Checksums, readline_generator, version_key
 from repo.models import Plugin, Tag, User
+from repo.search import index_plugins, unindex_plugins
 
+# ids of committed tags by name, tags are never deleted
+_tag_ids = {}
+_tag_lock = threading.Lock()
 
-def plugin_upload(user: User, package: io.BytesIO):
-    existing_plugin = Plugin.query.filter_by(md5_sum=md5(package)).first()
-    if existing_plugin:
-        return (False, "uploaded Plugin is a duplicate!")
 
-    # Check if we can open the zip file
+def plugin_dir():
+    """Return the directory plugins are stored in."""
+    return Path(app.root_path) / Path(app.config["GBD_PLUGIN_PATH"])
+
+
+# metadata.txt entries the plugin table can't do without
+REQUIRED_METADATA = (
+    "name",
+    "version",
+    "description",
+    "about",
+    "author",
+    "email",
+    "repository",
+    "qgisminimumversion",
+)
+
+# a parsed package that passed all checks that don't need the database
+PreparedUpload = namedtuple(
+    "PreparedUpload",
+    [
+        "package_path",
+        "checksums",
+        "metadata",
+        "name",
+        "version",
+        "package_name",
+        "qgis_minimum_key",
+        "qgis_maximum_key",
+        # the file name and content of the icon, or None
+        "icon",
+    ],
+)
+
+
+def store_icon(data, suffix):
+    """Store an icon under the hash of its content and return its file name.
+
+    Identical icons are stored once and an icon file never changes, so it can
+    be cached forever.
+    """
+    icon_name = hashlib.sha256(data).hexdigest() + suffix.lower()
+    icon_path = Path(app.root_path) / app.config["GBD_ICON_PATH"] / icon_name
+    if not icon_path.exists():
+        # uploads in other threads and processes may store the same icon
+        temp_path = icon_path.with_name(
+            f"{icon_name}.{os.getpid()}.{threading.get_ident()}.part"
+        )
+        try:
+            temp_path.write_bytes(data)
+            os.replace(temp_path, icon_path)
+        except OSError:
+            temp_path.unlink(missing_ok=True)
+            if not icon_path.exists():
+                raise
+    return icon_name
+
+
+def plugin_upload(user: User, package_path: Path, checksums: Checksums):
+    """Add an uploaded plugin to the repository.
+
+    Arguments:
+    ---------
+        user : User
+            the uploading user.
+        package_path : Path
+            the uploaded zip file, spooled into plugin_dir() by
+            helpers.spool_upload. It is moved into place or deleted.
+        checksums : Checksums
+            the checksums of the zip file.
+    """
+    return plugin_upload_many(user, [(package_path, checksums)])[0]
+
+
+def plugin_upload_many(user: User, packages):
+    """Add several uploaded plugins to the repository in one transaction.
+
+    The packages are parsed in parallel and added with a single commit. A
+    package that fails is rolled back on its own, the others are only moved
+    into place once the commit succeeded. A package that can't be moved is
+    undone again.
+
+    Arguments:
+    ---------
+        user : User
+            the uploading user.
+        packages : list
+            (package_path, checksums) pairs as for plugin_upload.
+
+    Returns a (success, result) pair per package, in the given order.
+    """
+    for package_path, _ in packages:
+        metrics.inc("upload_bytes_total", package_path.stat().st_size)
+    try:
+        return _plugin_upload_many(user, packages)
+    finally:
+        for package_path, _ in packages:
+            package_path.unlink(missing_ok=True)
+
+
+def _plugin_upload_many(user: User, packages):
+    results = [None] * len(packages)
+
+    # one indexed lookup, rejects duplicates before the zip files are parsed
+    existing_checksums = {
+        md5_sum
+        for (md5_sum,) in db.session.query(Plugin.md5_sum).filter(
+            Plugin.md5_sum.in_({checksums.md5 for _, checksums in packages})
+        )
+    }
+    pending = []
+    for i, (package_path, checksums) in enumerate(packages):
+        if checksums.md5 in existing_checksums:
+            results[i] = (False, "uploaded Plugin is a duplicate!")
+        else:
+            existing_checksums.add(checksums.md5)
+            pending.append(i)
+
+    workers = min(len(pending), app.config["GBD_UPLOAD_WORKERS"])
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            prepared = list(
+                executor.map(lambda i: prepare_package(*packages[i]), pending)
+            )
+    else:
+        prepared = [prepare_package(*packages[i]) for i in pending]
+
+    package_names = [result.package_name for success, result in prepared if success]
+    added, added_names, snapshots = [], set(), {}
+    try:
+        # on SQLite the savepoint takes the write lock, no other upload can add
+        # a plugin with one of these file names until this one committed
+        with db.session.begin_nested():
+            # plugins already in the repository by file name, in one query
+            old_plugins = {
+                plugin.file_name: plugin
+                for plugin in Plugin.query.filter(Plugin.file_name.in_(package_names))
+            }
+            for i, (success, result) in zip(pending, prepared):
+                if success and result.package_name in added_names:
+                    success = False
+                    result = f"{result.package_name} is uploaded twice."
+                elif success:
+                    old_plugin = old_plugins.get(result.package_name)
+                    if old_plugin:
+                        snapshots[result.package_name] = plugin_snapshot(
+                            old_plugin, result
+                        )
+                    success, result = add_plugin_nested(user, result, old_plugin)
+                if success:
+                    added.append((i, *result))
+                    added_names.add(result[0].package_name)
+                else:
+                    results[i] = (False, result)
+        if not added:
+            # release the write lock
+            db.session.rollback()
+            return results
+
+        with metrics.timer("upload_phase_seconds", phase="commit"):
+            # the search index needs the ids of new plugins
+            db.session.flush()
+            index_plugins(plugin for _, _, plugin in added)
+            # the rows and the new catalog generation commit together
+            mark_catalog_changed()
+            db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        if not isinstance(e, IntegrityError):
+            app.logger.warning(e)
+        checksums = {i: packages[i][1].md5 for i in pending if results[i] is None}
+        duplicates = {
+            md5_sum
+            for (md5_sum,) in db.session.query(Plugin.md5_sum).filter(
+                Plugin.md5_sum.in_(checksums.values())
+            )
+        }
+        for i, md5_sum in checksums.items():
+            if md5_sum in duplicates:
+                # the same package was uploaded concurrently
+                results[i] = (False, "uploaded Plugin is a duplicate!")
+            else:
+                results[i] = (False, "Error creating plugin. See logs for details.")
+        return results
+
+    clear_cache()
+    remember_tags(tag for _, _, plugin in added for tag in plugin.tags)
+    failed = []
+    for i, upload, plugin in added:
+        # only committed packages replace the files that are served
+        try:
+            with metrics.timer("upload_phase_seconds", phase="disk_write"):
+                os.replace(upload.package_path, plugin_dir() / upload.package_name)
+        except OSError as e:
+            app.logger.error(f"writing of plugin {upload.package_name} failed: {e}")
+            results[i] = (False, "writing of plugin failed")
+            failed.append((upload, plugin))
+            continue
+        mode = "CREATED" if upload.package_name not in old_plugins else "UPDATED"
+        app.logger.info(f"PLUGIN_{mode}: {upload.name} by user {user.name}")
+        results[i] = (True, (plugin.id, plugin.version))
+    if failed:
+        undo_uploads(failed, snapshots)
+    return results
+
+
+# columns add_plugin sets besides the ones from metadata.txt
+UPLOAD_COLUMNS = (
+    "qgis_minimum_key",
+    "qgis_maximum_key",
+    "md5_sum",
+    "sha256_sum",
+    "file_name",
+    "user_id",
+)
+
+
+def plugin_snapshot(plugin: Plugin, upload: PreparedUpload):
+    """Return the columns and tags of a plugin that an upload overwrites."""
+    columns = set(upload.metadata) & set(plugin.__table__.columns.keys())
+    columns.update(UPLOAD_COLUMNS)
+    return {key: getattr(plugin, key) for key in columns}, list(plugin.tags)
+
+
+def undo_uploads(failed, snapshots):
+    """Undo committed uploads whose package could not be moved into place.
+
+    New plugins are deleted, updated ones get back the values of their
+    snapshot, which match the package that is still served.
+
+    Arguments:
+    ---------
+        failed : list
+            (upload, plugin) pairs of the committed uploads.
+        snapshots : dict
+            plugin_snapshot of the updated plugins, by package name.
+    """
+    restored = []
     try:
-        zip_file = ZipFile(package)
-    except BadZipFile:
-        return (False, "broken zip file!")
+        for upload, plugin in failed:
+            snapshot = snapshots.get(upload.package_name)
+            if snapshot is None:
+                # mirrors may have seen the plugin already
+                add_tombstone(plugin, plugin.public, plugin.role_ids)
+                unindex_plugins([plugin.id])
+                db.session.delete(plugin)
+                continue
+            columns, tags = snapshot
+            for key, value in columns.items():
+                setattr(plugin, key, value)
+            plugin.tags = tags
+            restored.append(plugin)
+        db.session.flush()
+        index_plugins(restored)
+        invalidate_catalog()
+    except SQLAlchemyError:
+        db.session.rollback()
+        app.logger.exception("undoing the failed uploads failed")
 
-    # Check if the zip file contains a metadata.txt file
-    metadata_files = list(
-        filter(lambda x: x.endswith("metadata.txt"), zip_file.namelist())
+
+def prepare_package(package_path: Path, checksums: Checksums):
+    """Call prepare_upload, an unexpected error only rejects this package."""
+    try:
+        return prepare_upload(package_path, checksums)
+    except Exception:
+        app.logger.exception(f"reading uploaded package {package_path} failed")
+        return (False, "Error reading plugin. See logs for details.")
+
+
+def prepare_upload(package_path: Path, checksums: Checksums):
+    """Parse and check an uploaded package, without touching the database.
+
+    Safe to run in parallel. Returns (True, PreparedUpload) or (False, error).
+    """
+    with metrics.timer("upload_phase_seconds", phase="unzip"):
+        # Check if we can open the zip file
+        try:
+            zip_file = ZipFile(package_path)
+        except BadZipFile:
+            return (False, "broken zip file!")
+
+        # Check if the zip file contains a metadata.txt file
+        metadata_files = list(
+            filter(lambda x: x.endswith("metadata.txt"), zip_file.namelist())
+        )
+        if not len(metadata_files) == 1:
+            return (False, "missing metadata.txt")
+
+        metadata_file = metadata_files.pop()
+
+    with zip_file:
+        with metrics.timer("upload_phase_seconds", phase="metadata"):
+            # Try to read metadata.txt
+            try:
+                metadata = zip_file.open(metadata_file)
+                config = ConfigParser()
+                config.read_file(readline_generator(metadata))
+
+                metadata_dict = dict(config.items("general"))
+                name = metadata_dict.get("name")
+                plugin_version = metadata_dict.get("version")
+
+            except ConfigParserError:
+                return (False, "invalid metadata.txt file")
+            except UnicodeDecodeError:
+                return (False, "metadata.txt is not UTF-8 encoded")
+            except (BadZipFile, zlib.error):
+                return (False, "broken zip file!")
+
+        missing = [key for key in REQUIRED_METADATA if not metadata_dict.get(key)]
+        if missing:
+            return (False, f"missing {', '.join(missing)} in metadata.txt")
+
+        if not metadata_dict.get("qgismaximumversion"):
+            default_maximum = Plugin.__table__.c.qgismaximumversion.default.arg
+            metadata_dict["qgismaximumversion"] = default_maximum
+        try:
+            qgis_minimum_key = version_key(metadata_dict.get("qgisminimumversion", ""))
+            qgis_maximum_key = version_key(metadata_dict.get("qgismaximumversion"))
+        except InvalidVersion:
+            return (False, "invalid QGIS version in metadata.txt")
+
+        # Set package_name
+        if Path(metadata_file).parent.name:
+            package_name = f"{Path(metadata_file).parent.name}.zip"
+        else:
+            package_name = f"{name.lower().replace(' ', '_').replace('-', '_')}.zip"
+
+        # Read icon if any
+        icon = None
+        if "icon" in metadata_dict.keys():
+            zip_icon_path = Path(package_name).stem / Path(metadata_dict.get("icon"))
+            filename = (
+                f"{Path(package_name).stem}{Path(metadata_dict.get('icon')).suffix}"
+            )
+            with metrics.timer("upload_phase_seconds", phase="icon"):
+                try:
+                    icon = (filename, zip_file.read(str(zip_icon_path)))
+                except KeyError:
+                    return (False, f"icon {zip_icon_path} is missing in the zip file")
+                except (BadZipFile, zlib.error):
+                    return (False, "broken zip file!")
+
+    return (
+        True,
+        PreparedUpload(
+            package_path,
+            checksums,
+            metadata_dict,
+            name,
+            plugin_version,
+            package_name,
+            qgis_minimum_key,
+            qgis_maximum_key,
+            icon,
+        ),
     )
-    if not len(metadata_files) == 1:
-        return (False, "missing metadata.txt")
 
-    metadata_file = metadata_files.pop()
 
-    # Try to read metadata.txt
+def add_plugin_nested(user: User, upload: PreparedUpload, old_plugin=None):
+    """Add a prepared upload in a savepoint, so a failure only rejects it.
+
+    Takes and returns the same as add_plugin.
+    """
     try:
-        metadata = zip_file.open(metadata_file)
-        config = ConfigParser()
-        config.read_file(readline_generator(metadata))
+        with db.session.begin_nested():
+            success, result = add_plugin(user, upload, old_plugin)
+            if success:
+                db.session.flush()
+    except SQLAlchemyError as e:
+        if not isinstance(e, IntegrityError):
+            app.logger.warning(e)
+        duplicate = db.session.query(
+            Plugin.query.filter(Plugin.md5_sum == upload.checksums.md5).exists()
+        ).scalar()
+        if duplicate:
+            # the same package was uploaded concurrently
+            return (False, "uploaded Plugin is a duplicate!")
+        return (False, "Error creating plugin. See logs for details.")
+    return (success, result)
 
-        metadata_dict = dict(config.items("general"))
-        name = metadata_dict.get("name")
-        plugin_version = metadata_dict.get("version")
 
-    except ConfigParserError:
-        return (False, "invalid metadata.txt file")
+def add_plugin(user: User, upload: PreparedUpload, old_plugin=None):
+    """Add a prepared upload to the session.
 
-    # Set package_name
-    if Path(metadata_file).parent.name:
-        package_name = f"{Path(metadata_file).parent.name}.zip"
-    else:
-        package_name = f"{name.lower().replace(' ', '_').replace('-', '_')}.zip"
+    Arguments:
+    ---------
+        user : User
+            the uploading user.
+        upload : PreparedUpload
+            the package as returned by prepare_upload.
+        old_plugin : Plugin
+            the plugin with the same file name, if there is one.
 
-    # Save icon if any
-    if "icon" in metadata_dict.keys():
-        zip_icon_path = Path(package_name).stem / Path(metadata_dict.get("icon"))
-        filename = f"{Path(package_name).stem}{Path(metadata_dict.get('icon')).suffix}"
-        icon_path = Path(app.config["GBD_ICON_PATH"]) / filename
-        with open(icon_path, "wb") as icon_file:
-            icon_file.write(zip_file.read(str(zip_icon_path)))
-        metadata_dict.update({"icon": url_for("get_icon", filename=filename)})
-
-    # close zip file:
-    zip_file.close()
-
-    # Check if there already is a plugin with that name
-    old_plugin = Plugin.query.filter_by(file_name=package_name).first()
+    Returns (True, (upload, plugin)) or (False, error). Nothing is committed
+    and the package stays where it is until the caller committed.
+    """
     if old_plugin and version.parse(old_plugin.version) >= version.parse(
-        plugin_version
+        upload.version
     ):
         return (
             False,
-            f"There already exist a version of the plugin {package_name} that is the same or newer.",
+            f"There already exist a version of the plugin {upload.package_name} that is the same or newer.",
         )
 
-    # Write package to disk
-    try:
-        plugin_path = (
-            Path(app.root_path)
-            / Path(app.config["GBD_PLUGIN_PATH"])
-            / Path(package_name)
-        )
-        with open(plugin_path, "wb") as out_file:
-            package.seek(0)
-            out_file.write(package.read())
+    metadata_dict = dict(upload.metadata)
 
-    except IOError:
-        return (False, "writing of plugin failed")
+    # Save icon if any
+    if upload.icon:
+        filename, icon_data = upload.icon
+        with metrics.timer("upload_phase_seconds", phase="icon"):
+            icon_name = store_icon(icon_data, Path(filename).suffix)
+        metadata_dict.update({"icon": url_for("get_icon", filename=icon_name)})
 
     # modify plugin in db
-    if old_plugin:
-        plugin = old_plugin
-        mode = "UPDATED"
-    else:
-        plugin = Plugin()
-        mode = "CREATED"
+    plugin = old_plugin or Plugin()
 
     if "tags" in metadata_dict.keys():
-        tag_name_list = metadata_dict.get("tags").split(",")
-        tag_list = []
-        for tag_name in tag_name_list:
-            tag = Tag.query.filter(Tag.name == tag_name).first()
-            if not tag:
-                tag = Tag(name=tag_name)
-            tag_list.append(tag)
-        db.session.add_all(tag_list)
-        db.session.commit()
-        metadata_dict.update({"tags": tag_list})
+        metadata_dict.update({"tags": get_tags(metadata_dict.get("tags"))})
 
     for key, value in metadata_dict.items():
         if (
@@ -118,18 +463,54 @@ def plugin_upload(user: User, package: io.BytesIO):
             value = value == "True"
         setattr(plugin, key, value)
 
-    plugin.md5_sum = md5(package)
-    plugin.file_name = package_name
+    plugin.qgis_minimum_key = upload.qgis_minimum_key
+    plugin.qgis_maximum_key = upload.qgis_maximum_key
+    plugin.md5_sum = upload.checksums.md5
+    plugin.sha256_sum = upload.checksums.sha256
+    plugin.file_name = upload.package_name
     plugin.user_id = user.id
+    db.session.add(plugin)
+    return (True, (upload, plugin))
+
+
+def normalize_tags(tags):
+    """Split the tags of metadata.txt into names without duplicates."""
+    names = {}
+    for tag_name in tags.split(","):
+        tag_name = re.sub(r"\s+", " ", tag_name).strip()
+        if tag_name:
+            names[tag_name] = None
+    return list(names)
+
+
+def get_tags(tags):
+    """Return the Tag objects for the tags of metadata.txt.
+
+    Unknown tags are looked up with one query and missing ones are inserted
+    with one statement, in the transaction of the upload. Ids of committed
+    tags are cached, see remember_tags.
+    """
+    names = normalize_tags(tags)
+    with _tag_lock:
+        tag_ids = {name: _tag_ids[name] for name in names if name in _tag_ids}
+    missing = [name for name in names if name not in tag_ids]
+    if missing:
+        # another upload may insert the same tags at the same time
+        db.session.execute(
+            insert_ignore(Tag.__table__, db.session.get_bind().dialect),
+            [{"name": name} for name in missing],
+        )
+        tag_ids.update(db.session.query(Tag.name, Tag.id).filter(Tag.name.in_(missing)))
+    # attach the tags without loading them again
+    tag_list = []
+    for name in names:
+        tag = Tag(id=tag_ids[name], name=name)
+        make_transient_to_detached(tag)
+        tag_list.append(db.session.merge(tag, load=False))
+    return tag_list
 
-    try:
-        db.session.add(plugin)
-        db.session.commit()
-    except SQLAlchemyError as e:
-        app.logger.warning(e.statement)
-        app.logger.warning(e.params)
-        app.logger.warning(e.orig)
-        return (False, "Error creating plugin. See logs for details.")
 
-    app.logger.info(f"PLUGIN_{mode}: {name} by user {user.name}")
-    return (True, (plugin.id, plugin.version))
+def remember_tags(tags):
+    """Cache the ids of tags once they are committed."""
+    with _tag_lock:
+        _tag_ids.update((tag.name, tag.id) for tag in tags)
@@ -0,0 +1,33 @@
+"""Fixtures running the app on a temporary SQLite database."""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    """Return the app, set up with a temporary database and plugin directory.
+
+    The app reads its configuration on import, so all tests share it.
+    """
+    tmp = tmp_path_factory.mktemp("repo")
+    os.environ.update(
+        SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp / 'plugin.db'}",
+        GBD_PLUGIN_PATH=str(tmp / "dl"),
+        GBD_ICON_PATH=f"{tmp / 'icons'}/",
+        GBD_METRICS_DIR="",
+    )
+    sys.path.insert(0, str(ROOT))
+    from repo import app
+
+    app.config["TESTING"] = True
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,47 @@
+"""Query strings and host names must not grow the catalog cache without bound."""
+
+
+def test_only_whole_qgis_releases_and_all_fields_cached(app, client):
+    from repo import catalog
+
+    catalog.clear_cache()
+    assert client.get("/plugins.xml?qgis=3.34").status_code == 200
+    assert client.get("/plugins.json").status_code == 200
+    assert len(catalog._cache) == 2
+    for url in [
+        "/plugins.xml?qgis=3.34.1",
+        "/plugins.xml?qgis=3.34.2",
+        "/plugins.json?fields=name",
+        "/plugins.json?fields=name,version",
+    ]:
+        assert client.get(url).status_code == 200
+    assert len(catalog._cache) == 2
+
+
+def test_cache_capped_by_bytes(app, client, monkeypatch):
+    from repo import catalog
+
+    catalog.clear_cache()
+    client.get("/plugins.xml", base_url="http://a.example.com")
+    size = len(next(iter(catalog._cache.values())).body)
+    monkeypatch.setitem(app.config, "GBD_CATALOG_CACHE_BYTES", 2 * size)
+    for host in "bcd":
+        client.get("/plugins.xml", base_url=f"http://{host}.example.com")
+    assert [key[0] for key in catalog._cache] == [
+        "http://c.example.com/",
+        "http://d.example.com/",
+    ]
+    # a compressed variant counts as well, it pushes out the older catalog
+    client.get(
+        "/plugins.xml",
+        base_url="http://d.example.com",
+        headers={"Accept-Encoding": "gzip"},
+    )
+    assert "http://c.example.com/" not in [key[0] for key in catalog._cache]
+    assert (
+        sum(
+            len(entry.body) + sum(map(len, entry.encoded.values()))
+            for entry in catalog._cache.values()
+        )
+        <= 2 * size
+    )
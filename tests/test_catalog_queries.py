@@ -0,0 +1,99 @@
+"""The queries of a plugins.xml request must not grow with the catalog."""
+import base64
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+def basic_auth(username, password):
+    token = base64.b64encode(f"{username}:{password}".encode()).decode()
+    return {"Authorization": f"Basic {token}"}
+
+
+@pytest.fixture
+def users(app):
+    """Return the request headers of an anonymous, a role and a superuser."""
+    from repo import db
+    from repo.models import Role, User
+
+    with app.app_context():
+        member = User(name="member", superuser=False, roles=[Role(name="members")])
+        member.set_password("member")
+        db.session.add_all([member, Role(name="others")])
+        db.session.commit()
+    return {
+        "anonymous": {},
+        "role": basic_auth("member", "member"),
+        "superuser": basic_auth("admin", "admin"),
+    }
+
+
+def add_plugins(app, count):
+    """Add public plugins and plugins of both roles, each with two tags."""
+    from repo import db
+    from repo.catalog import invalidate_catalog
+    from repo.helpers import version_key
+    from repo.models import Plugin, Role, Tag, User
+
+    with app.app_context():
+        admin = User.query.filter_by(name="admin").one()
+        roles = Role.query.order_by(Role.id).all()
+        start = Plugin.query.count()
+        for i in range(start, start + count):
+            plugin = Plugin(
+                md5_sum=f"{i:032x}",
+                file_name=f"plugin{i}.zip",
+                user_id=admin.id,
+                public=i % 3 == 0,
+                name=f"Plugin{i}",
+                qgisminimumversion="3.0",
+                qgis_minimum_key=version_key("3.0"),
+                qgis_maximum_key=version_key("3.99"),
+                description=f"Plugin {i}",
+                about="About it.",
+                version="1.0",
+                author="Author",
+                email="author@example.com",
+                repository="https://example.com/",
+                tags=[Tag(name=f"tag{i}"), Tag(name=f"other{i}")],
+            )
+            if not plugin.public:
+                plugin.roles.append(roles[i % len(roles)])
+            db.session.add(plugin)
+        invalidate_catalog()
+
+
+def count_queries(client, headers):
+    """Return the queries and plugins of an uncached plugins.xml request."""
+    from repo.catalog import clear_cache
+
+    queries = [0]
+
+    def count_query(*args):
+        queries[0] += 1
+
+    clear_cache()
+    # read-only requests use their own engine, count the queries of all engines
+    event.listen(Engine, "before_cursor_execute", count_query)
+    try:
+        response = client.get("/plugins.xml", headers=headers)
+    finally:
+        event.remove(Engine, "before_cursor_execute", count_query)
+    assert response.status_code == 200
+    return queries[0], response.data.count(b"<pyqgis_plugin")
+
+
+def test_catalog_queries_do_not_grow_with_plugins(app, client, users):
+    add_plugins(app, 3)
+    for headers in users.values():
+        # verified credentials are cached after the first request
+        client.get("/plugins.xml", headers=headers)
+    small = {name: count_queries(client, headers) for name, headers in users.items()}
+
+    add_plugins(app, 30)
+    large = {name: count_queries(client, headers) for name, headers in users.items()}
+
+    for name in users:
+        assert large[name][1] > small[name][1]
+        assert large[name][0] == small[name][0], name
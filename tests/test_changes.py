@@ -0,0 +1,109 @@
+"""Mirrors syncing with /plugins/changes.xml must not drop visible plugins."""
+import base64
+import itertools
+import re
+
+import pytest
+
+
+def basic_auth(username, password):
+    token = base64.b64encode(f"{username}:{password}".encode()).decode()
+    return {"Authorization": f"Basic {token}"}
+
+
+ADMIN = basic_auth("admin", "admin")
+_names = itertools.count()
+
+
+@pytest.fixture
+def alpha(app):
+    """Add a public plugin and a user with a role.
+
+    Returns the ids and the request headers of the user.
+    """
+    from repo import db
+    from repo.catalog import invalidate_catalog
+    from repo.helpers import version_key
+    from repo.models import Plugin, Role, User
+
+    n = next(_names)
+    with app.app_context():
+        role = Role(name=f"mirrors{n}")
+        mirror = User(name=f"mirror{n}", superuser=False, roles=[role])
+        mirror.set_password("mirror-password")
+        admin = User.query.filter_by(name="admin").one()
+        plugin = Plugin(
+            md5_sum=f"{n:a>32}",
+            file_name=f"alpha{n}.zip",
+            user_id=admin.id,
+            public=True,
+            name=f"alpha{n}",
+            qgisminimumversion="3.0",
+            qgis_minimum_key=version_key("3.0"),
+            qgis_maximum_key=version_key("3.99"),
+            description="Alpha",
+            about="About alpha.",
+            version="1.0",
+            author="Author",
+            email="author@example.com",
+            repository="https://example.com/",
+        )
+        db.session.add_all([mirror, plugin])
+        invalidate_catalog()
+        return {
+            "name": plugin.name.encode(),
+            "plugin": plugin.id,
+            "role": role.id,
+            "user": mirror.id,
+            "headers": basic_auth(mirror.name, "mirror-password"),
+        }
+
+
+def changes(client, headers, since=None):
+    """Return the deleted and updated plugin names and the next cursor."""
+    url = "/plugins/changes.xml" + (f"?since={since}" if since else "")
+    response = client.get(url, headers=headers)
+    assert response.status_code == 200
+    deleted = re.findall(rb'<deleted_plugin id="\d+" name="(\w+)"', response.data)
+    updated = re.findall(rb'<pyqgis_plugin version="[^"]+" name="(\w+)"', response.data)
+    cursor = re.search(rb'next="([^"]+)"', response.data)
+    return deleted, updated, cursor and cursor.group(1).decode()
+
+
+def restrict(client, alpha):
+    """Make the plugin visible to its role only."""
+    response = client.post(
+        f"/plugin/{alpha['plugin']}/edit",
+        data={f"role_{alpha['role']}": "on"},
+        headers=ADMIN,
+    )
+    assert response.status_code == 302
+
+
+def test_restricted_plugin_is_kept_by_users_that_can_see_it(app, client, alpha):
+    _, _, anonymous_cursor = changes(client, {})
+    restrict(client, alpha)
+
+    deleted, updated, cursor = changes(client, alpha["headers"])
+    assert alpha["name"] in updated
+    assert changes(client, alpha["headers"], cursor) == ([], [], cursor)
+    # anonymous users lost the plugin
+    assert changes(client, {}, anonymous_cursor)[0] == [alpha["name"]]
+
+
+def test_deleted_role_removes_plugin_from_mirrors(app, client, alpha):
+    restrict(client, alpha)
+    _, _, cursor = changes(client, alpha["headers"])
+
+    response = client.get(f"/role/{alpha['role']}/delete", headers=ADMIN)
+    assert response.status_code == 302
+    assert changes(client, alpha["headers"], cursor)[0] == [alpha["name"]]
+
+
+def test_removed_user_role_removes_plugin_from_mirrors(app, client, alpha):
+    restrict(client, alpha)
+    _, _, cursor = changes(client, alpha["headers"])
+
+    response = client.post(f"/user/{alpha['user']}/edit", data={}, headers=ADMIN)
+    assert response.status_code == 302
+    assert changes(client, alpha["headers"], cursor)[0] == [alpha["name"]]
@@ -0,0 +1,162 @@
+"""Uploads through plugin.upload_many report and store every package on its own."""
+import base64
+import io
+import itertools
+import os
+import threading
+import xmlrpc.client
+import zipfile
+
+ADMIN = {"Authorization": "Basic " + base64.b64encode(b"admin:admin").decode()}
+_names = itertools.count()
+
+
+def metadata(name, encoding="utf-8", version="1.0"):
+    """Return the metadata.txt of a plugin, the author has a non-ASCII name."""
+    return (
+        "[general]\n"
+        f"name={name}\n"
+        "qgisMinimumVersion=3.0\n"
+        f"description=Plugin {name}\n"
+        f"about=About {name}.\n"
+        f"version={version}\n"
+        "author=Jürgen\n"
+        "email=author@example.com\n"
+        "repository=https://example.com/\n"
+        "icon=icon.png\n"
+    ).encode(encoding)
+
+
+def package(name, metadata_txt=None, icon=True, version="1.0"):
+    """Return a zipped plugin."""
+    stem = name.lower()
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_file:
+        zip_file.writestr(
+            f"{stem}/metadata.txt", metadata_txt or metadata(name, version=version)
+        )
+        if icon:
+            zip_file.writestr(f"{stem}/icon.png", b"PNG " + name.encode())
+    return buffer.getvalue()
+
+
+def upload_many(client, *packages):
+    """Call plugin.upload_many and return its results."""
+    body = xmlrpc.client.dumps(
+        ([xmlrpc.client.Binary(p) for p in packages],), "plugin.upload_many"
+    )
+    headers = dict(ADMIN, **{"Content-Type": "text/xml"})
+    response = client.post("/rpc", data=body, headers=headers)
+    assert response.status_code == 200
+    return xmlrpc.client.loads(response.data)[0][0]
+
+
+def test_broken_packages_rejected_on_their_own(app, client):
+    from repo.upload import plugin_dir
+
+    n = next(_names)
+    good, no_icon, latin = f"Good{n}", f"NoIcon{n}", f"Latin{n}"
+    results = upload_many(
+        client,
+        package(good),
+        package(no_icon, icon=False),
+        package(latin, metadata(latin, "latin-1")),
+    )
+    assert results[0]["success"]
+    assert results[1] == {
+        "success": False,
+        "result": f"icon {no_icon.lower()}/icon.png is missing in the zip file",
+    }
+    assert results[2] == {
+        "success": False,
+        "result": "metadata.txt is not UTF-8 encoded",
+    }
+    with app.app_context():
+        assert (plugin_dir() / f"{good.lower()}.zip").exists()
+
+
+def fail_replace(monkeypatch, package_name):
+    """Make moving the package with the given file name into place fail."""
+    replace = os.replace
+
+    def failing_replace(src, dst):
+        if os.path.basename(dst) == package_name:
+            raise OSError("disk full")
+        replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", failing_replace)
+
+
+def test_failed_write_removes_new_plugin(app, client, monkeypatch):
+    from repo.models import Plugin
+
+    name = f"Unwritten{next(_names)}"
+    fail_replace(monkeypatch, f"{name.lower()}.zip")
+    results = upload_many(client, package(name))
+    assert results == [{"success": False, "result": "writing of plugin failed"}]
+    with app.app_context():
+        assert not Plugin.query.filter_by(name=name).count()
+    assert name.encode() not in client.get("/plugins.xml").data
+
+
+def test_failed_write_restores_updated_plugin(app, client, monkeypatch):
+    from repo.models import Plugin
+
+    name = f"Unchanged{next(_names)}"
+    assert upload_many(client, package(name))[0]["success"]
+    fail_replace(monkeypatch, f"{name.lower()}.zip")
+    results = upload_many(client, package(name, version="2.0"))
+    assert results == [{"success": False, "result": "writing of plugin failed"}]
+    with app.app_context():
+        plugin = Plugin.query.filter_by(name=name).one()
+        assert plugin.version == "1.0"
+    assert f'version="1.0" name="{name}"'.encode() in client.get("/plugins.xml").data
+
+
+def test_concurrent_uploads_keep_one_plugin_per_file(app):
+    from repo.models import Plugin
+
+    name = f"Concurrent{next(_names)}"
+    threads = [
+        threading.Thread(
+            target=upload_many,
+            args=(app.test_client(), package(name, version=f"{v}.0")),
+        )
+        for v in range(1, 5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with app.app_context():
+        assert Plugin.query.filter_by(file_name=f"{name.lower()}.zip").count() == 1
+
+
+def test_same_icon_stored_concurrently(app, monkeypatch):
+    from repo.upload import store_icon
+
+    data = f"PNG {next(_names)}".encode()
+    errors = []
+    # all threads have written their file before the first one moves it
+    barrier = threading.Barrier(4, timeout=5)
+    replace = os.replace
+
+    def waiting_replace(src, dst):
+        barrier.wait()
+        replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", waiting_replace)
+
+    def store():
+        try:
+            with app.app_context():
+                store_icon(data, ".PNG")
+        except OSError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=store) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors